@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Per-response cost of pulling readerObj/pageNum/imgUrl out of reader pages
+
+Usage (from crawler/): python -m benchmarks.extract_vars [RESPONSE_CACHE_DIR]
+
+Reader pages recorded by the response cache are used when a cache dir is given, otherwise
+pages of a similar shape are synthesised.
+"""
+import json
+import re
+import sys
+import time
+from pathlib import Path
+
+from scrapy.http import Headers, HtmlResponse
+
+from zjlibpd_crawler.middlewares import ResponseCacheMiddleware
+from zjlibpd_crawler.spiders.books import extract_var, extract_vars
+
+VARNAMES = ("readerObj", "pageNum", "imgUrl")
+
+
+def load_recorded(cache_dir, limit=2000):
+    pages = []
+    for path in Path(cache_dir).glob("reader/*/*.gz"):
+        header, body = ResponseCacheMiddleware.read_entry(path)
+        headers = Headers(header["headers"])
+        pages.append(HtmlResponse(header["url"], headers=headers, body=body).text)
+        if len(pages) >= limit:
+            break
+    return pages
+
+
+def synthesise(count=2000):
+    pages = []
+    for i in range(count):
+        chapters = [
+            {"title": f"卷{j}", "page": j * 10 + 1, "subChapters": []}
+            for j in range(50)
+        ]
+        reader_obj = {"fileName": f"{i:04}", "fileType": ".pdf", "chapters": chapters}
+        script = "\n".join(f"    var v{j} = '{'x' * 40}';" for j in range(200))
+        pages.append(
+            f"""<html><head><script>
+{script}
+    var readerObj = {json.dumps(reader_obj, ensure_ascii=False)};
+    var pageNum = {i % 500 + 1};
+    var imgUrl = encodeURIComponent("https://history.zjlib.cn/blob/{i:08x}/pdfImgaes/");
+</script></head><body>{'<div></div>' * 2000}</body></html>"""
+        )
+    return pages
+
+
+def uncached_extract_var(varname, html):
+    # what extract_var used to do: compile a fresh pattern for every call
+    m = re.search(rf"var\s+{varname}\s*=\s*(.+?)\s*;?\s*$", html, flags=re.MULTILINE)
+    return m.group(1)
+
+
+def bench(name, fn, pages, rounds=3):
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for page in pages:
+            fn(page)
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<24} {best / len(pages) * 1e6:10.1f} us/response")
+    return best
+
+
+def main():
+    pages = load_recorded(sys.argv[1]) if len(sys.argv) > 1 else []
+    source = "recorded"
+    if not pages:
+        pages, source = synthesise(), "synthesised"
+    size = sum(map(len, pages)) / len(pages)
+    print(f"{len(pages)} {source} reader pages, {size / 1024:.1f} KiB on average")
+
+    for page in pages:
+        assert extract_vars(page, *VARNAMES) == [
+            uncached_extract_var(varname, page) for varname in VARNAMES
+        ]
+    before = bench(
+        "re.search per var",
+        lambda page: [uncached_extract_var(varname, page) for varname in VARNAMES],
+        pages,
+    )
+    bench(
+        "extract_var per var",
+        lambda page: [extract_var(varname, page) for varname in VARNAMES],
+        pages,
+    )
+    after = bench("extract_vars", lambda page: extract_vars(page, *VARNAMES), pages)
+    print(f"speedup: {before / after:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
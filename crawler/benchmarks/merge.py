@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""Per-resource cost of merging listing records, mergedeep vs merge_resource
+
+Usage (from crawler/): python -m benchmarks.merge [ITEMS_JSONL]
+
+With a crawled items.json(.all), each top-level resource is merged the way gen1 does:
+its volumes listed in sub_resources with their own records. Otherwise listing records of
+the stand-in site are merged into their details, as parse_item does. Also counts the
+merges whose fields read differently from mergedeep's (see lookups).
+"""
+import copy
+import json
+import sys
+import time
+
+from mergedeep import Strategy, merge
+
+from benchmarks.standin import StandInSite
+from zjlibpd_crawler.merge import merge_resource
+
+
+def load_recorded(path):
+    mapping = {}
+    with open(path) as f:
+        for line in f:
+            item = json.loads(line)
+            mapping[item["id"]] = item
+    return [
+        (sub, mapping[sub["id"]])
+        for item in mapping.values()
+        for sub in item.get("sub_resources", [])
+        if sub["id"] in mapping
+    ]
+
+
+def load_standin(size=5000):
+    site = StandInSite(size)
+    return [(site.details[record["id"]], record) for record in site.records]
+
+
+def lookups(fields):
+    """What was read from the merged fields: `__ATTRS__`, in which the last match won, and
+    the reader URLs of the first match"""
+    attrs = {field["key"]: field.get("subs") or field.get("value") for field in fields}
+    reader = next(
+        (field for field in fields if field["key"] in ("获取方式", "阅读")), {}
+    )
+    return attrs, reader.get("orsUrl"), reader.get("subs")
+
+
+def timed(fn, pairs, rounds=3):
+    best = float("inf")
+    for _ in range(rounds):
+        # mergedeep modifies its destination in place
+        pairs_copy = copy.deepcopy(pairs)
+        start = time.perf_counter()
+        for dst, src in pairs_copy:
+            fn(dst, src)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    pairs = load_recorded(sys.argv[1]) if len(sys.argv) > 1 else load_standin()
+    fields = [
+        (
+            merge(copy.deepcopy(dst), src, strategy=Strategy.TYPESAFE_ADDITIVE)[
+                "fields"
+            ],
+            merge_resource(dst, src)["fields"],
+        )
+        for dst, src in pairs
+    ]
+    print(
+        f"{len(pairs)} merges, fields per result: mergedeep {sum(len(a) for a, _ in fields) / len(pairs):.1f}, merge_resource {sum(len(b) for _, b in fields) / len(pairs):.1f}"
+    )
+    differing = sum(lookups(a) != lookups(b) for a, b in fields)
+    print(f"merges read differently from mergedeep: {differing}")
+
+    old = timed(
+        lambda dst, src: merge(dst, src, strategy=Strategy.TYPESAFE_ADDITIVE), pairs
+    )
+    new = timed(merge_resource, pairs)
+    print(f"mergedeep:      {old / len(pairs) * 1e6:8.1f} us/merge")
+    print(f"merge_resource: {new / len(pairs) * 1e6:8.1f} us/merge ({old / new:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""Offline throughput benchmark of BooksSpider and the item pipelines
+
+Usage (from crawler/):
+    python -m benchmarks.replay callbacks [--size N] [--pipeline PATH ...]
+    python -m benchmarks.replay crawl [--size N] [--pipeline PATH ...] [-s NAME=VALUE ...]
+
+`callbacks` feeds responses of a synthetic stand-in site straight into the spider
+callbacks and the pipelines, without any networking, which isolates their CPU cost.
+`crawl` runs a complete crawl against the same stand-in served over HTTP from a
+subprocess. Both report responses/sec and the peak RSS of the crawling process.
+"""
+import argparse
+import multiprocessing
+import resource
+import time
+from collections import defaultdict, deque
+
+from scrapy.crawler import Crawler, CrawlerProcess
+from scrapy.http import HtmlResponse, TextResponse
+from scrapy.utils.misc import create_instance, load_object
+from scrapy.utils.project import get_project_settings
+
+from benchmarks.standin import StandInSite, serve
+from zjlibpd_crawler.spiders.books import BooksSpider
+
+
+def peak_rss_mib():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def make_settings(args):
+    settings = get_project_settings()
+    settings.set("LOG_LEVEL", "WARNING", priority="cmdline")
+    # never append to the items.json of real crawls
+    settings.set("FEEDS", {}, priority="cmdline")
+    settings.set(
+        "ITEM_PIPELINES",
+        {path: 300 + i for i, path in enumerate(args.pipeline)},
+        priority="cmdline",
+    )
+    for s in args.set:
+        name, _, value = s.partition("=")
+        settings.set(name, value, priority="cmdline")
+    return settings
+
+
+def replay_callbacks(args):
+    site = StandInSite(args.size)
+    settings = make_settings(args)
+    crawler = Crawler(BooksSpider, settings)
+    crawler.stats = load_object(settings["STATS_CLASS"])(crawler)
+    spider = BooksSpider.from_crawler(crawler, base_url=site.base_url)
+    crawler.spider = spider
+    # no engine opens the spider here
+    spider.spider_opened(spider)
+    pipelines = [
+        create_instance(load_object(path), settings, crawler) for path in args.pipeline
+    ]
+    for pipeline in pipelines:
+        if hasattr(pipeline, "open_spider"):
+            pipeline.open_spider(spider)
+
+    timings = defaultdict(lambda: [0, 0.0])
+    items = 0
+    pipeline_time = 0.0
+    queue = deque(spider.start_requests())
+    start = time.perf_counter()
+    while queue:
+        request = queue.popleft()
+        status, content_type, body = site.respond(
+            request.method, request.url, request.body
+        )
+        assert status == 200, request
+        respcls = TextResponse if content_type == "application/json" else HtmlResponse
+        response = respcls(
+            request.url,
+            status=status,
+            headers={"Content-Type": content_type},
+            body=body,
+            request=request,
+        )
+
+        callback_start = time.perf_counter()
+        outputs = list(request.callback(response))
+        timing = timings[request.callback.__name__]
+        timing[0] += 1
+        timing[1] += time.perf_counter() - callback_start
+
+        for output in outputs:
+            if isinstance(output, dict):
+                items += 1
+                pipeline_start = time.perf_counter()
+                for pipeline in pipelines:
+                    output = pipeline.process_item(output, spider)
+                pipeline_time += time.perf_counter() - pipeline_start
+            else:
+                queue.append(output)
+    for pipeline in pipelines:
+        if hasattr(pipeline, "close_spider"):
+            pipeline.close_spider(spider)
+    spider.closed("finished")
+    elapsed = time.perf_counter() - start
+
+    responses = sum(count for count, _ in timings.values())
+    for name, (count, seconds) in sorted(timings.items()):
+        print(
+            f"{name:<14} {count:8} responses {seconds:8.2f}s {count / seconds:10.1f} responses/sec"
+        )
+    if pipelines:
+        print(
+            f"{'pipelines':<14} {items:8} items     {pipeline_time:8.2f}s {items / pipeline_time:10.1f} items/sec"
+        )
+    print(
+        f"total: {responses} responses, {items} items in {elapsed:.2f}s ({responses / elapsed:.1f} responses/sec), peak RSS {peak_rss_mib():.1f} MiB"
+    )
+
+
+def replay_crawl(args):
+    ready = multiprocessing.Queue()
+    server = multiprocessing.Process(
+        target=serve, args=(StandInSite(args.size),), kwargs={"ready": ready}
+    )
+    server.start()
+    try:
+        port = ready.get(timeout=60)
+        process = CrawlerProcess(make_settings(args))
+        crawler = process.create_crawler(BooksSpider)
+        process.crawl(crawler, base_url=f"http://127.0.0.1:{port}")
+        process.start()
+    finally:
+        server.kill()
+
+    stats = crawler.stats.get_stats()
+    elapsed = stats["elapsed_time_seconds"]
+    responses = stats.get("response_received_count", 0)
+    print(
+        f"total: {responses} responses, {stats.get('item_scraped_count', 0)} items in {elapsed:.2f}s ({responses / elapsed:.1f} responses/sec), peak RSS {peak_rss_mib():.1f} MiB"
+    )
+    for key, value in sorted(stats.items()):
+        if key.startswith("callback/"):
+            print(f"{key}: {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("mode", choices=["callbacks", "crawl"])
+    parser.add_argument("--size", type=int, default=2000, help="number of books")
+    parser.add_argument(
+        "--pipeline", action="append", default=[], help="item pipeline to include"
+    )
+    parser.add_argument(
+        "-s", dest="set", action="append", default=[], help="override a setting"
+    )
+    args = parser.parse_args()
+    if args.mode == "callbacks":
+        replay_callbacks(args)
+    else:
+        replay_crawl(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""A synthetic stand-in of the history.zjlib.cn endpoints used by BooksSpider
+
+It serves search-list pages, resource details pages and reader pages of a generated
+corpus, either in process (StandInSite.respond) or over HTTP (serve).
+"""
+
+import json
+import random
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+LEFT_LETTERS = list("abcdefghijklmnopqrstuvwxyz") + ["other"]
+FIELD_KEYS = [
+    "题名", "类型", "责任者", "出版者", "出版时间", "版本", "装帧", "尺寸", "页数",
+    "语种", "主题", "分类", "馆藏地", "索书号", "附注", "提要", "丛书", "版权",
+]  # fmt: skip
+
+
+# replaced by the actual base URL when pages are rendered, as it is only known once bound
+BASE_URL = "{base_url}"
+
+
+def object_id(n):
+    return f"{0x62B5518E3157D263EE000000 + n:024x}"
+
+
+class StandInSite:
+    """A corpus of `size` books, some of them with volumes, and the pages describing it"""
+
+    def __init__(
+        self,
+        size,
+        base_url="http://standin.local",
+        seed=0,
+        max_page_size=100,
+        record_limit=100000,
+    ):
+        self.base_url = base_url
+        self.max_page_size = max_page_size
+        self.record_limit = record_limit
+        rng = random.Random(seed)
+        self.records = []
+        self.details = {}
+        self.readers = {}
+        for n in range(size):
+            id = object_id(n)
+            subs = []
+            for v in range(rng.choice([0, 0, 0, 1, 2, 4, 8])):
+                sub_id = object_id(size + n * 16 + v)
+                subs.append(
+                    {
+                        "id": sub_id,
+                        "fields": self.fields(rng, sub_id, f"第{v + 1}冊", "卷"),
+                    }
+                )
+                self.add_resource(rng, sub_id, "卷")
+            self.add_resource(rng, id, "书" if subs else "卷", subs)
+            self.records.append(
+                {
+                    "id": id,
+                    "letter": rng.choice(LEFT_LETTERS),
+                    "fields": self.fields(rng, id, f"書{n}", "书")[:6],
+                    "sub_resources": subs,
+                }
+            )
+
+    def fields(self, rng, id, title, type_):
+        fields = [{"key": "题名", "value": title}, {"key": "类型", "value": type_}]
+        for key in FIELD_KEYS[2:]:
+            fields.append(
+                {"key": key, "value": "".join(rng.choices("經史子集叢書卷冊", k=12))}
+            )
+        return fields
+
+    def add_resource(self, rng, id, type_, subs=()):
+        fields = self.fields(rng, id, f"題{id[-6:]}", type_)
+        if not subs:
+            files = rng.choice([1, 1, 1, 2])
+            urls = [f"{BASE_URL}/reader/{id}/{i}" for i in range(files)]
+            fields.append(
+                {
+                    "key": "获取方式",
+                    "subs": [{"fieldType": "file", "orsUrl": url} for url in urls],
+                }
+            )
+            for i in range(files):
+                self.readers[f"{id}/{i}"] = rng.randint(20, 400)
+        self.details[id] = {"id": id, "fields": fields}
+
+    def respond(self, method, url, body=None):
+        """Return (status, content type, body) for a request to the site"""
+        path = urlparse(url).path
+        if method == "POST" and path.endswith("/universal-search/search-list"):
+            return 200, "application/json", self.search_list(json.loads(body))
+        if m := re.search(r"/resource/(\w+)/details$", path):
+            if d := self.details.get(m.group(1)):
+                return 200, "text/html; charset=utf-8", self.details_page(d)
+        if m := re.search(r"/reader/(\w+/\d+)$", path):
+            if (pages := self.readers.get(m.group(1))) is not None:
+                return (
+                    200,
+                    "text/html; charset=utf-8",
+                    self.reader_page(m.group(1), pages),
+                )
+        return 404, "text/plain", b"not found"
+
+    def search_list(self, query):
+        records = self.records
+        for c in query.get("classifies", []):
+            if c["pid"] == "left_letter":
+                letter = c["id"].split(":", 1)[1]
+                records = [r for r in records if r["letter"] == letter]
+        total = len(records)
+        records = records[: self.record_limit]
+        page, page_size = query["page"], min(query["pageSize"], self.max_page_size)
+        results = [
+            {k: v for k, v in r.items() if k != "letter"}
+            for r in records[(page - 1) * page_size : page * page_size]
+        ]
+        d = {
+            "code": 1,
+            "data": {
+                "curPage": page,
+                "totalRecords": total,
+                "totalPages": -(-total // page_size),
+                "results": results,
+            },
+        }
+        return json.dumps(d, ensure_ascii=False).encode("utf-8")
+
+    def details_page(self, d):
+        script = "\n".join(f"    var v{i} = {i};" for i in range(40))
+        return f"""<!DOCTYPE html><html><head><script>
+{script}
+    var resDatails = {json.dumps(d, ensure_ascii=False).replace(BASE_URL, self.base_url)};
+</script></head><body>{'<div class="x"></div>' * 300}</body></html>""".encode(
+            "utf-8"
+        )
+
+    def reader_page(self, key, pages):
+        chapters = [
+            {"title": f"卷{i}", "page": i * 10 + 1, "subChapters": []}
+            for i in range(pages // 10)
+        ]
+        reader_obj = {"fileName": "0001", "fileType": ".pdf", "chapters": chapters}
+        script = "\n".join(f"    var v{i} = {i};" for i in range(80))
+        return f"""<!DOCTYPE html><html><head><script>
+{script}
+    var readerObj = {json.dumps(reader_obj, ensure_ascii=False)};
+    var pageNum = {pages};
+    var imgUrl = encodeURIComponent("https://history.zjlib.cn/blob/{key.replace('/', '-')}/pdfImgaes/");
+</script></head><body>{'<div class="page"></div>' * 600}</body></html>""".encode(
+            "utf-8"
+        )
+
+
+def serve(site, host="127.0.0.1", port=0, ready=None):
+    """Serve the site over HTTP until killed; `ready` receives the bound port"""
+
+    class Handler(BaseHTTPRequestHandler):
+        # keep-alive, as the crawler reuses its connections
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.reply(*site.respond("GET", self.path))
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.reply(*site.respond("POST", self.path, body))
+
+        def reply(self, status, content_type, body):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    site.base_url = f"http://{host}:{server.server_address[1]}"
+    if ready is not None:
+        ready.put(server.server_address[1])
+    server.serve_forever()
@@ -1,41 +1,253 @@
 #!/usr/bin/env python3
-import sys
+"""Check that the sub resources of every item were crawled, with readers
+
+Usage: validate.py [--index PATH] < items.json
+       validate.py [--index PATH] [-j JOBS] items.json
+       validate.py [--index PATH] --follow items.json
+
+Prints `id, number of subs, number of distinct reader blobs` for every item whose subs
+are all fine, and the problems of the others to stderr. Items are streamed: only the sub
+ids of items and the hashes of the reader blobs of every id are kept, in memory or, with
+--index, in an SQLite file. With --follow, the feed of a running crawl is watched and items
+are printed as soon as all their subs have been crawled; the remaining ones are checked
+once interrupted (Ctrl-C). A file given without --follow is decoded by JOBS processes.
+"""
+import argparse
+import hashlib
 import json
+import sqlite3
+import sys
+import time
+
+from zjlibpd_crawler.jsonl import load
+
+
+class MemoryTables:
+
+    def __init__(self):
+        # id -> hashes of its reader blobs, or None if it has no (complete) __READER__
+        self.readers = {}
+        # items with subs, in order: seq -> (id, sub ids)
+        self.parents = {}
+        # sub id -> seqs of the parents waiting on it, with --follow
+        self.waiting = {}
+
+    def add_readers(self, id, blobs):
+        self.readers[id] = blobs
+
+    def get_readers(self, id, default=None):
+        return self.readers.get(id, default)
+
+    def add_parent(self, seq, id, subs):
+        self.parents[seq] = (id, subs)
+
+    def get_parent(self, seq):
+        return self.parents[seq]
+
+    def remove_parent(self, seq):
+        _id, subs = self.parents.pop(seq)
+        for sub in subs:
+            if (seqs := self.waiting.get(sub)) is not None:
+                seqs.discard(seq)
+                if not seqs:
+                    del self.waiting[sub]
+
+    def iter_parents(self):
+        return list(self.parents.items())
+
+    def wait_for(self, seq, subs):
+        for sub in subs:
+            self.waiting.setdefault(sub, set()).add(seq)
+
+    def waiting_on(self, ids):
+        return {seq for id in ids for seq in self.waiting.get(id, ())}
+
+
+class SqliteTables:
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(
+            """
+            DROP TABLE IF EXISTS readers;
+            DROP TABLE IF EXISTS parents;
+            DROP TABLE IF EXISTS waiting;
+            CREATE TABLE readers (id TEXT PRIMARY KEY, blobs TEXT);
+            CREATE TABLE parents (seq INTEGER PRIMARY KEY, id TEXT, subs TEXT);
+            CREATE TABLE waiting (sub TEXT, seq INTEGER, PRIMARY KEY (sub, seq));
+            CREATE INDEX waiting_seq ON waiting (seq);
+            """
+        )
+
+    def add_readers(self, id, blobs):
+        self.db.execute(
+            "INSERT OR REPLACE INTO readers VALUES (?, ?)",
+            (id, None if blobs is None else json.dumps(blobs)),
+        )
+
+    def get_readers(self, id, default=None):
+        row = self.db.execute(
+            "SELECT blobs FROM readers WHERE id = ?", (id,)
+        ).fetchone()
+        if row is None:
+            return default
+        return None if row[0] is None else tuple(json.loads(row[0]))
+
+    def add_parent(self, seq, id, subs):
+        self.db.execute(
+            "INSERT INTO parents VALUES (?, ?, ?)", (seq, id, " ".join(subs))
+        )
+
+    def get_parent(self, seq):
+        id, subs = self.db.execute(
+            "SELECT id, subs FROM parents WHERE seq = ?", (seq,)
+        ).fetchone()
+        return id, tuple(subs.split(" "))
+
+    def remove_parent(self, seq):
+        self.db.execute("DELETE FROM parents WHERE seq = ?", (seq,))
+        self.db.execute("DELETE FROM waiting WHERE seq = ?", (seq,))
+
+    def iter_parents(self):
+        for seq, id, subs in self.db.execute("SELECT * FROM parents ORDER BY seq"):
+            yield seq, (id, tuple(subs.split(" ")))
+
+    def wait_for(self, seq, subs):
+        self.db.executemany(
+            "INSERT OR IGNORE INTO waiting VALUES (?, ?)", ((sub, seq) for sub in subs)
+        )
+
+    def waiting_on(self, ids):
+        return {
+            seq
+            for id in ids
+            for (seq,) in self.db.execute(
+                "SELECT seq FROM waiting WHERE sub = ?", (id,)
+            )
+        }
+
+
+MISSING = object()
+
+
+def compact(e):
+    """The id, reader blob hashes and sub ids of an item, which is all that is checked"""
+    if (reader := e.get("__READER__")) is None or None in reader:
+        # failed reader pages leave None in their slots
+        blobs = None
+    else:
+        blobs = tuple(
+            {blob_hash(r if isinstance(r, str) else r["imgUrl"]) for r in reader}
+        )
+    subs = tuple(sub["id"] for sub in e.get("sub_resources") or ())
+    return e["id"], blobs, subs
+
+
+def blob_hash(url):
+    # unlike hash(), stable across the processes decoding the items
+    return int.from_bytes(hashlib.blake2b(url.encode(), digest_size=8).digest())
+
+
+def add_items(items, tables, seq=0):
+    for id, blobs, subs in items:
+        tables.add_readers(id, blobs)
+        if subs:
+            tables.add_parent(seq, id, subs)
+            seq += 1
+    return seq
+
+
+def check(id, subs, tables, report=True):
+    """Return the number of distinct reader blobs of the subs, or None and the count of
+    subs without reader if some is missing"""
+    blobs = set()
+    mrc = 0
+    nostat = False
+    for sub in subs:
+        readers = tables.get_readers(sub, MISSING)
+        if readers is MISSING:
+            # possibly the resource page or its reader page is broken
+            if report:
+                print(f"missing sub: {id} -> {sub}", file=sys.stderr)
+            nostat = True
+        elif readers is None:
+            # the resource has no read link
+            if report:
+                print(f"missing reader: {id} -> {sub}", file=sys.stderr)
+            mrc += 1
+            nostat = True
+        else:
+            blobs.update(readers)
+    return (None if nostat else len(blobs)), mrc
+
+
+def follow(path, interval=1.0):
+    """Yield batches of the lines appended to the file"""
+    with open(path) as f:
+        partial = ""
+        while True:
+            lines = f.readlines()
+            if lines:
+                lines[0] = partial + lines[0]
+                # the crawler may be in the middle of writing the last line
+                partial = "" if lines[-1].endswith("\n") else lines.pop()
+            if lines:
+                yield lines
+            else:
+                time.sleep(interval)
 
 
 def main():
-    d = []
-    for line in sys.stdin:
-        d.append(json.loads(line))
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("path", nargs="?", help="items.json to read instead of stdin")
+    parser.add_argument("--index", help="keep the tables in this SQLite file")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="processes decoding the file (default: all cores)",
+    )
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="watch the file while it is being written by a crawl",
+    )
+    args = parser.parse_args()
+    if args.follow and not args.path:
+        parser.error("--follow needs the path of the items file")
+    tables = SqliteTables(args.index) if args.index else MemoryTables()
 
-    m = {e["id"]: e for e in d}
+    if args.follow:
+        seq = 0
+        try:
+            for lines in follow(args.path):
+                items = [compact(json.loads(line)) for line in lines]
+                # only the new parents and those waiting on the new items can be complete
+                affected = tables.waiting_on(id for id, _blobs, _subs in items)
+                new_seq = add_items(items, tables, seq)
+                affected.update(range(seq, new_seq))
+                for parent_seq in sorted(affected):
+                    id, subs = tables.get_parent(parent_seq)
+                    stat, _ = check(id, subs, tables, report=False)
+                    if stat is not None:
+                        print(id, len(subs), stat, flush=True)
+                        tables.remove_parent(parent_seq)
+                    elif parent_seq >= seq:
+                        tables.wait_for(parent_seq, subs)
+                seq = new_seq
+        except KeyboardInterrupt:
+            pass
+    elif args.path:
+        add_items(load(args.path, args.jobs, transform=compact), tables)
+    else:
+        add_items(map(compact, map(json.loads, sys.stdin)), tables)
 
     mrc = 0
-    for e in d:
-        if subs := e.get("sub_resources"):
-            nostat = False
-            for sub in subs:
-                if sub["id"] not in m:
-                    # possibly the resource page or its reader page is broken
-                    print(f"missing sub: {e['id']} -> {sub['id']}", file=sys.stderr)
-                    nostat = True
-                elif "__READER__" not in m[sub["id"]]:
-                    # the resource has no read link
-                    print(f"missing reader: {e['id']} -> {sub['id']}", file=sys.stderr)
-                    mrc += 1
-                    nostat = True
-            if not nostat:
-                print(
-                    e["id"],
-                    len(subs),
-                    len(
-                        set(
-                            r if isinstance(r, str) else r["imgUrl"]
-                            for sub in subs
-                            for r in m[sub["id"]]["__READER__"]
-                        )
-                    ),
-                )
+    for _seq, (id, subs) in tables.iter_parents():
+        stat, missing_readers = check(id, subs, tables)
+        mrc += missing_readers
+        if stat is not None:
+            print(id, len(subs), stat)
     print("missing reader count:", mrc, file=sys.stderr)
 
 
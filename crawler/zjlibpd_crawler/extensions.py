@@ -0,0 +1,101 @@
+# Define here the extensions of the project
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/extensions.html
+
+import datetime
+import json
+import os
+import re
+import time
+from pathlib import Path
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+
+
+class StatsExporter:
+    """Periodically write the crawl stats to a JSON file and/or a Prometheus textfile
+
+    Besides the stats collected elsewhere, it samples the scheduler/downloader queue depth
+    and the item and response rates since the last export.
+    """
+
+    def __init__(self, crawler, json_path, prometheus_path, interval):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.json_path = json_path and Path(json_path)
+        self.prometheus_path = prometheus_path and Path(prometheus_path)
+        self.interval = interval
+        self.last = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        json_path = crawler.settings.get("STATS_EXPORT_JSON")
+        prometheus_path = crawler.settings.get("STATS_EXPORT_PROMETHEUS")
+        if not json_path and not prometheus_path:
+            raise NotConfigured
+        o = cls(
+            crawler,
+            json_path,
+            prometheus_path,
+            crawler.settings.getfloat("STATS_EXPORT_INTERVAL", 60),
+        )
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        return o
+
+    def spider_opened(self, spider):
+        self.task = task.LoopingCall(self.export)
+        self.task.start(self.interval, now=False)
+
+    def spider_closed(self, spider, reason):
+        if self.task.running:
+            self.task.stop()
+        self.export()
+
+    def export(self):
+        self.sample()
+        stats = self.stats.get_stats()
+        if self.json_path:
+            write_atomically(self.json_path, json.dumps(stats, default=str, indent=1))
+        if self.prometheus_path:
+            write_atomically(self.prometheus_path, to_prometheus(stats))
+
+    def sample(self):
+        engine = self.crawler.engine
+        if engine.slot is not None:
+            self.stats.set_value("queue/scheduled", len(engine.slot.scheduler))
+        self.stats.set_value("queue/downloading", len(engine.downloader.active))
+
+        now = time.monotonic()
+        items = self.stats.get_value("item_scraped_count", 0)
+        responses = self.stats.get_value("response_received_count", 0)
+        if self.last:
+            last_time, last_items, last_responses = self.last
+            elapsed = now - last_time
+            self.stats.set_value("rate/items_per_sec", (items - last_items) / elapsed)
+            self.stats.set_value(
+                "rate/responses_per_sec", (responses - last_responses) / elapsed
+            )
+        self.last = (now, items, responses)
+
+
+def to_prometheus(stats, prefix="zjlibpd_"):
+    lines = []
+    for key, value in sorted(stats.items()):
+        if isinstance(value, datetime.datetime):
+            value = value.timestamp()
+        elif isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        name = prefix + re.sub(r"[^a-zA-Z0-9_]", "_", key)
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_atomically(path, text):
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_text(text)
+    os.replace(tmp_path, path)
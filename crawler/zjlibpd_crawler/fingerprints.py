@@ -0,0 +1,69 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+
+def fingerprint(record):
+    """A stable digest of a record (e.g. a listing record or an item), insensitive to key order"""
+    return sized_fingerprint(record)[0]
+
+
+def sized_fingerprint(record):
+    """The fingerprint of a record and the length of the JSON it digests, in bytes"""
+    data = json.dumps(
+        record, sort_keys=True, ensure_ascii=False, separators=(",", ":")
+    ).encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).hexdigest(), len(data)
+
+
+class FingerprintIndex:
+    """Fingerprints of the listing records whose items were crawled completely, by id
+
+    Stored as a plain `id<TAB>fingerprint` file which is rewritten on save. If a pending path
+    is given (e.g. in JOBDIR), the fingerprints of items requested but not complete yet are
+    saved there too, so that a resumed crawl still moves them into the index.
+    """
+
+    def __init__(self, path, pending_path=None):
+        self.path = Path(path)
+        self.pending_path = pending_path and Path(pending_path)
+        self.fingerprints = self._load(self.path)
+        # fingerprints of requested items, moved into the index once the item is complete
+        self.pending = self._load(self.pending_path) if self.pending_path else {}
+
+    def unchanged(self, id, fp):
+        return self.fingerprints.get(id) == fp
+
+    def expect(self, id, fp):
+        self.pending[id] = fp
+
+    def complete(self, id):
+        if (fp := self.pending.pop(id, None)) is not None:
+            self.fingerprints[id] = fp
+
+    def save(self):
+        self._save(self.path, self.fingerprints)
+        if self.pending_path:
+            if self.pending:
+                self._save(self.pending_path, self.pending)
+            else:
+                self.pending_path.unlink(missing_ok=True)
+
+    @staticmethod
+    def _load(path):
+        fingerprints = {}
+        if path.exists():
+            with open(path) as f:
+                for line in f:
+                    id, fp = line.rstrip("\n").split("\t")
+                    fingerprints[id] = fp
+        return fingerprints
+
+    @staticmethod
+    def _save(path, fingerprints):
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            for id, fp in fingerprints.items():
+                f.write(f"{id}\t{fp}\n")
+        os.replace(tmp_path, path)
@@ -0,0 +1,55 @@
+import os
+from pathlib import Path
+
+ID_SIZE = 12  # resource ids are hex-encoded 12-byte ObjectIds
+
+
+class ResourceIdSet:
+    """A persistent set of resource ids
+
+    Stored as the sorted concatenation of the raw 12-byte ids, so that a million ids take
+    12 MB on disk and in memory, and lookups are binary searches. Ids added in this run are
+    kept in a plain set and merged into the file on save.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.data = self.path.read_bytes() if self.path.exists() else b""
+        assert len(self.data) % ID_SIZE == 0, f"Corrupted id set {self.path}"
+        self.added = set()
+
+    def __contains__(self, id):
+        key = bytes.fromhex(id)
+        if key in self.added:
+            return True
+        data = self.data
+        lo, hi = 0, len(data) // ID_SIZE
+        while lo < hi:
+            mid = (lo + hi) // 2
+            probe = data[mid * ID_SIZE : (mid + 1) * ID_SIZE]
+            if probe < key:
+                lo = mid + 1
+            elif probe > key:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def count(self):
+        return len(self.data) // ID_SIZE + len(self.added)
+
+    def add(self, id):
+        if id not in self:
+            self.added.add(bytes.fromhex(id))
+
+    def save(self):
+        if not self.added:
+            return
+        ids = [self.data[i : i + ID_SIZE] for i in range(0, len(self.data), ID_SIZE)]
+        ids.extend(self.added)
+        ids.sort()
+        self.data = b"".join(ids)
+        self.added = set()
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        tmp_path.write_bytes(self.data)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,77 @@
+"""Parallel decoding of large JSON lines files, such as items.json.all
+
+The file is memory-mapped and split into chunks on line boundaries, which are decoded by
+a pool of processes (with orjson if it is installed); items are yielded in file order.
+"""
+
+import json
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import orjson
+
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def load(path, jobs=None, with_offsets=False, transform=None, chunk_size=CHUNK_SIZE):
+    """Yield the items of a JSON lines file in order
+
+    With `with_offsets`, (offset of the line, item) pairs are yielded instead. `transform`,
+    if given, is applied to each item in the worker processes, which saves sending whole
+    items back when only a part of them is needed; it must be picklable (i.e. defined at
+    the top level of a module).
+    """
+    jobs = jobs or os.cpu_count() or 1
+    bounds = chunk_bounds(path, chunk_size)
+    if jobs == 1 or len(bounds) == 1:
+        for start, end in bounds:
+            yield from decode_chunk(path, start, end, with_offsets, transform)
+        return
+
+    with ProcessPoolExecutor(jobs) as executor:
+        # at most two chunks per worker in flight, to bound the memory held by results
+        pending = []
+        for start, end in bounds:
+            pending.append(
+                executor.submit(decode_chunk, path, start, end, with_offsets, transform)
+            )
+            if len(pending) >= jobs * 2:
+                yield from pending.pop(0).result()
+        for future in pending:
+            yield from future.result()
+
+
+def chunk_bounds(path, chunk_size=CHUNK_SIZE):
+    """(start, end) offsets of consecutive chunks of about `chunk_size`, ending after a newline"""
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    bounds = []
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        start = 0
+        while start < size:
+            end = m.find(b"\n", min(start + chunk_size, size) - 1)
+            end = size if end == -1 else end + 1
+            bounds.append((start, end))
+            start = end
+    return bounds
+
+
+def decode_chunk(path, start, end, with_offsets=False, transform=None):
+    items = []
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        offset = start
+        for line in m[start:end].splitlines(keepends=True):
+            if line.strip():
+                item = loads(line)
+                if transform is not None:
+                    item = transform(item)
+                items.append((offset, item) if with_offsets else item)
+            offset += len(line)
+    return items
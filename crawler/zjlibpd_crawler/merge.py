@@ -0,0 +1,78 @@
+"""Merging of zjlib resource records
+
+A replacement for `mergedeep.merge(dst, src, strategy=Strategy.TYPESAFE_ADDITIVE)` that
+knows about the resource schema. mergedeep deep-copies every value taken from the source
+and concatenates lists, so merging a listing record into its details page duplicates
+every entry of `fields` (and of `sub_resources`).
+"""
+
+# lists of dicts that are merged entry by entry, by the given key
+KEYED_LISTS = {"fields": "key", "sub_resources": "id"}
+
+
+def merge_resource(dst, src):
+    """Return `dst` merged with `src`, leaving both untouched
+
+    Dicts are merged recursively and a value from `src` replaces a scalar in `dst`, raising
+    TypeError if their types differ, as TYPESAFE_ADDITIVE does. Lists named in KEYED_LISTS
+    are merged by key (see merge_field for entries of `fields`); other lists are
+    concatenated. Nothing is copied deeply: subtrees present on one side only are shared
+    with the result.
+    """
+    merged = dict(dst)
+    for key, value in src.items():
+        if key not in merged:
+            merged[key] = value
+            continue
+        existing = merged[key]
+        if existing is value:
+            continue
+        if type(existing) is not type(value):
+            raise TypeError(
+                f'destination type: {type(existing)} differs from source type: {type(value)} for key: "{key}"'
+            )
+        if isinstance(value, dict):
+            merged[key] = merge_resource(existing, value)
+        elif isinstance(value, list):
+            if key in KEYED_LISTS:
+                merge_entry = merge_field if key == "fields" else merge_resource
+                merged[key] = merge_keyed(
+                    existing, value, KEYED_LISTS[key], merge_entry
+                )
+            else:
+                merged[key] = existing + value
+        else:
+            merged[key] = value
+    return merged
+
+
+def merge_keyed(dst, src, key, merge_entry):
+    """Merge two lists of dicts, combining the entries with the same `key` by `merge_entry`
+
+    Entries of `dst` keep their order; those only in `src` are appended. Entries without
+    the key are never combined.
+    """
+    merged = list(dst)
+    positions = {entry[key]: i for i, entry in enumerate(dst) if key in entry}
+    for entry in src:
+        if (i := positions.get(entry.get(key))) is None:
+            if key in entry:
+                positions[entry[key]] = len(merged)
+            merged.append(entry)
+        elif merged[i] is not entry:
+            merged[i] = merge_entry(merged[i], entry)
+    return merged
+
+
+def merge_field(dst, src):
+    """Merge two entries of `fields` into what lookups saw in mergedeep's concatenation
+
+    The reader URLs (`subs`, `orsUrl`) were looked up by the first match, i.e. the entry of
+    `dst`, which is kept as is. `__ATTRS__` was built by a dict comprehension, in which the
+    last match won, so the `value` of `src` replaces that of `dst`.
+    """
+    merged = dict(dst)
+    for key, value in src.items():
+        if key == "value" or key not in merged:
+            merged[key] = value
+    return merged
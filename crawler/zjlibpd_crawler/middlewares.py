@@ -3,7 +3,23 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import pickle
+import re
+import time
+from collections import defaultdict
+from pathlib import Path
+
 from scrapy import signals
+from scrapy.exceptions import DontCloseSpider, NotConfigured
+from scrapy.http import Headers, Request
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.request import request_from_dict
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
@@ -56,6 +72,132 @@ class ZjlibpdCrawlerSpiderMiddleware:
         spider.logger.info("Spider opened: %s" % spider.name)
 
 
+class CallbackStatsMiddleware:
+    """Record the CPU time and response bytes of each spider callback into stats
+
+    Installed closest to the spider, so that the time taken to iterate the result is the
+    time spent in the callback itself.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.stats)
+
+    def process_spider_input(self, response, spider):
+        name = self.callback_name(response)
+        self.stats.inc_value(f"callback/{name}/count")
+        self.stats.inc_value(f"callback/{name}/response_bytes", len(response.body))
+        return None
+
+    def process_spider_output(self, response, result, spider):
+        name = self.callback_name(response)
+        cpu_time = 0.0
+        try:
+            it = iter(result)
+            while True:
+                start = time.process_time()
+                try:
+                    r = next(it)
+                except StopIteration:
+                    break
+                finally:
+                    cpu_time += time.process_time() - start
+                yield r
+        finally:
+            self.stats.inc_value(f"callback/{name}/cpu_time", cpu_time)
+
+    @staticmethod
+    def callback_name(response):
+        callback = response.request.callback
+        return getattr(callback, "__name__", "parse")
+
+
+class BacklogLimitMiddleware:
+    """Hold back listing pages while too many requests are pending
+
+    Listing pages fan out into many details and reader requests. Once the scheduler and the
+    downloader hold BACKLOG_LIMIT requests, new listing pages are kept here (ordered by
+    priority) and only released as the backlog drains, so memory stays flat however large
+    the listing is. With JOBDIR, pages still held when the crawl is paused are saved there
+    and held again on resume, as nothing else would request them.
+    """
+
+    def __init__(self, crawler, limit):
+        self.crawler = crawler
+        self.limit = limit
+        self.held = []
+        self.seq = itertools.count()
+        jobdir = crawler.settings.get("JOBDIR")
+        self.state_path = Path(jobdir) / "backlog.pickle" if jobdir else None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if (limit := crawler.settings.getint("BACKLOG_LIMIT", 0)) <= 0:
+            raise NotConfigured
+        s = cls(crawler, limit)
+        crawler.signals.connect(s.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def spider_opened(self, spider):
+        if self.state_path is None or not self.state_path.exists():
+            return
+        with open(self.state_path, "rb") as f:
+            held = pickle.load(f)
+        for priority, d in held:
+            request = request_from_dict(d, spider=spider)
+            heapq.heappush(self.held, (priority, next(self.seq), request))
+        spider.logger.info(
+            f"Restored {len(held)} held listing pages from {self.state_path}"
+        )
+
+    def spider_closed(self, spider):
+        if self.state_path is None:
+            return
+        if not self.held:
+            self.state_path.unlink(missing_ok=True)
+            return
+        held = [
+            (priority, request.to_dict(spider=spider))
+            for priority, _seq, request in sorted(self.held)
+        ]
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.state_path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(held, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.state_path)
+        spider.logger.info(f"Saved {len(held)} held listing pages to {self.state_path}")
+
+    def backlog(self):
+        engine = self.crawler.engine
+        return len(engine.slot.scheduler) + len(engine.downloader.active)
+
+    def process_spider_output(self, response, result, spider):
+        for r in result:
+            if isinstance(r, Request) and "page_no" in r.meta:
+                heapq.heappush(self.held, (-r.priority, next(self.seq), r))
+                self.crawler.stats.inc_value("backlog/held")
+            else:
+                yield r
+        yield from self.release(self.limit - self.backlog())
+
+    def release(self, n):
+        for _ in range(min(n, len(self.held))):
+            *_, request = heapq.heappop(self.held)
+            self.crawler.stats.inc_value("backlog/released")
+            yield request
+
+    def spider_idle(self, spider):
+        if self.held:
+            for request in self.release(max(self.limit - self.backlog(), 1)):
+                self.crawler.engine.crawl(request)
+            raise DontCloseSpider
+
+
 class ZjlibpdCrawlerDownloaderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
     # scrapy acts as if the downloader middleware does not modify the
@@ -101,3 +243,239 @@ class ZjlibpdCrawlerDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info("Spider opened: %s" % spider.name)
+
+
+class ResponseCacheMiddleware:
+    """Cache details and reader pages on disk so that the corpus can be re-parsed offline
+
+    Unlike HTTPCACHE, entries are keyed by resource id (details pages) or by reader URL, so
+    they stay valid across changes of the query string or cookies. It is installed below
+    HttpCompressionMiddleware, so bodies are stored decoded (and then gzipped as a whole),
+    expire after RESPONSE_CACHE_EXPIRATION_SECS and the oldest ones are evicted once the
+    cache grows over RESPONSE_CACHE_MAX_BYTES (0 for both means unbounded).
+    """
+
+    def __init__(self, cache_dir, expiration_secs, max_bytes, stats):
+        self.cache_dir = Path(cache_dir)
+        self.expiration_secs = expiration_secs
+        self.max_bytes = max_bytes
+        self.stats = stats
+        # cached files in the order they were stored, for eviction
+        self.entries = {}
+        self.total_bytes = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not (cache_dir := crawler.settings.get("RESPONSE_CACHE_DIR")):
+            raise NotConfigured
+        s = cls(
+            cache_dir,
+            crawler.settings.getint("RESPONSE_CACHE_EXPIRATION_SECS", 0),
+            crawler.settings.getint("RESPONSE_CACHE_MAX_BYTES", 0),
+            crawler.stats,
+        )
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        return s
+
+    def spider_opened(self, spider):
+        files = []
+        for path in self.cache_dir.glob("*/*/*.gz"):
+            st = path.stat()
+            files.append((st.st_mtime, path, st.st_size))
+        files.sort()
+        for _mtime, path, size in files:
+            self.entries[path] = size
+            self.total_bytes += size
+        self.evict()
+        spider.logger.info(
+            f"Response cache at {self.cache_dir}: {len(self.entries)} entries, {self.total_bytes} bytes"
+        )
+
+    def process_request(self, request, spider):
+        if not (path := self.cache_path(request)):
+            return None
+        try:
+            mtime = path.stat().st_mtime
+        except FileNotFoundError:
+            self.stats.inc_value("response_cache/miss")
+            return None
+        if 0 < self.expiration_secs < time.time() - mtime:
+            self.stats.inc_value("response_cache/expired")
+            return None
+
+        header, body = self.read_entry(path)
+        headers = Headers(header["headers"])
+        respcls = responsetypes.from_args(headers=headers, url=header["url"], body=body)
+        self.stats.inc_value("response_cache/hit")
+        return respcls(
+            url=header["url"],
+            status=header["status"],
+            headers=headers,
+            body=body,
+            request=request,
+            flags=["cached"],
+        )
+
+    def process_response(self, request, response, spider):
+        if (
+            "cached" in response.flags
+            or response.status != 200
+            or not (path := self.cache_path(request))
+        ):
+            return response
+
+        header = {
+            "url": response.url,
+            "status": response.status,
+            "headers": {
+                k.decode(): [v.decode() for v in vs]
+                for k, vs in response.headers.items()
+                if k.lower() == b"content-type"
+            },
+        }
+        data = gzip.compress(json.dumps(header).encode() + b"\n" + response.body)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.total_bytes += len(data) - self.entries.pop(path, 0)
+        self.entries[path] = len(data)
+        self.stats.inc_value("response_cache/store")
+        self.evict()
+        return response
+
+    @staticmethod
+    def read_entry(path):
+        """The header (url, status and headers) and the body of a cache entry"""
+        with open(path, "rb") as f:
+            header, _, body = gzip.decompress(f.read()).partition(b"\n")
+        return json.loads(header), body
+
+    def cache_path(self, request):
+        if request.method != "GET":
+            # search-list pages are POSTed and always fetched live
+            return None
+        if m := re.search(r"/resource/(\w+)/details", request.url):
+            kind, key = "details", m.group(1)
+        elif "reader_index" in request.meta:
+            kind, key = "reader", hashlib.sha1(request.url.encode()).hexdigest()
+        else:
+            return None
+        return self.cache_dir / kind / key[-2:] / f"{key}.gz"
+
+    def evict(self):
+        if self.max_bytes <= 0 or self.total_bytes <= self.max_bytes:
+            return
+        # leave some headroom so that it does not run for every new entry
+        target = self.max_bytes * 0.9
+        while self.entries and self.total_bytes > target:
+            path = next(iter(self.entries))
+            self.total_bytes -= self.entries.pop(path)
+            path.unlink(missing_ok=True)
+            self.stats.inc_value("response_cache/evicted")
+
+
+class AdaptiveConcurrencyMiddleware:
+    """Tune the concurrency of each kind of history.zjlib.cn endpoint with AIMD
+
+    Listing, details and reader requests are put into downloader slots of their own. After
+    every ADAPTIVE_CONCURRENCY_WINDOW responses of a kind, the concurrency of its slot is
+    halved if too many of them failed (exceptions, 5xx/429, or `code != 1` listing payloads)
+    or if their 90th percentile latency exceeds ADAPTIVE_CONCURRENCY_TARGET_LATENCY, and is
+    increased by one otherwise. Note that CONCURRENT_REQUESTS still caps the total. It is
+    installed below HttpCompressionMiddleware, which has to decode listing payloads first.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.start = settings.getint("ADAPTIVE_CONCURRENCY_START", 4)
+        self.max = settings.getint("ADAPTIVE_CONCURRENCY_MAX", 32)
+        self.target_latency = settings.getfloat(
+            "ADAPTIVE_CONCURRENCY_TARGET_LATENCY", 2.0
+        )
+        self.max_error_rate = settings.getfloat(
+            "ADAPTIVE_CONCURRENCY_MAX_ERROR_RATE", 0.05
+        )
+        self.window = settings.getint("ADAPTIVE_CONCURRENCY_WINDOW", 20)
+        self.concurrency = {}
+        # (latency, failed) of the responses since the last adjustment, by endpoint
+        self.samples = defaultdict(list)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("ADAPTIVE_CONCURRENCY_ENABLED"):
+            raise NotConfigured
+        return cls(crawler)
+
+    def process_request(self, request, spider):
+        if endpoint := self.endpoint(request):
+            request.meta.setdefault("download_slot", f"zjlib-{endpoint}")
+            # slots are only created once their first request gets downloaded, and are
+            # garbage collected when idle, so keep applying the current concurrency
+            if slot := self.slot(request):
+                slot.concurrency = self.concurrency.setdefault(endpoint, self.start)
+        return None
+
+    def process_response(self, request, response, spider):
+        if "cached" in response.flags or not (endpoint := self.endpoint(request)):
+            return response
+        failed = response.status >= 500 or response.status == 429
+        if endpoint == "listing" and not failed:
+            # the body is decoded by HttpCompressionMiddleware by now; an undecodable one
+            # is left for the spider to report rather than counted against the slot
+            try:
+                payload = json.loads(response.body)
+            except ValueError:
+                payload = None
+            if isinstance(payload, dict):
+                failed = payload.get("code") != 1
+        self.record(request, endpoint, request.meta.get("download_latency"), failed)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        if endpoint := self.endpoint(request):
+            self.record(request, endpoint, request.meta.get("download_latency"), True)
+
+    def record(self, request, endpoint, latency, failed):
+        samples = self.samples[endpoint]
+        samples.append((latency, failed))
+        if len(samples) < self.window:
+            return
+        self.samples[endpoint] = []
+
+        latencies = sorted(latency for latency, _ in samples if latency is not None)
+        p50 = latencies[len(latencies) // 2] if latencies else 0.0
+        p90 = latencies[len(latencies) * 9 // 10] if latencies else 0.0
+        error_rate = sum(failed for _, failed in samples) / len(samples)
+        concurrency = self.concurrency.get(endpoint, self.start)
+        if error_rate > self.max_error_rate or p90 > self.target_latency:
+            concurrency = max(concurrency // 2, 1)
+        else:
+            concurrency = min(concurrency + 1, self.max)
+        self.concurrency[endpoint] = concurrency
+        if slot := self.slot(request):
+            slot.concurrency = concurrency
+
+        stats = self.crawler.stats
+        stats.set_value(f"adaptive/{endpoint}/concurrency", concurrency)
+        stats.set_value(f"adaptive/{endpoint}/latency_p50", round(p50, 3))
+        stats.set_value(f"adaptive/{endpoint}/latency_p90", round(p90, 3))
+        stats.set_value(f"adaptive/{endpoint}/error_rate", round(error_rate, 3))
+        self.crawler.spider.logger.debug(
+            f"Concurrency of {endpoint} set to {concurrency} (p50={p50:.3f}s, p90={p90:.3f}s, errors={error_rate:.1%})"
+        )
+
+    def slot(self, request):
+        return self.crawler.engine.downloader.slots.get(request.meta["download_slot"])
+
+    @staticmethod
+    def endpoint(request):
+        if "/universal-search/search-list" in request.url:
+            return "listing"
+        elif re.search(r"/resource/\w+/details", request.url):
+            return "details"
+        elif "reader_index" in request.meta:
+            return "reader"
+        return None
@@ -5,13 +5,31 @@
 
 
 # useful for handling different item types with a single interface
+import datetime
+import json
+import queue
+import threading
+import time
 import pymongo
 from pymongo import ReplaceOne
-from pymongo.errors import BulkWriteError
+from pymongo.errors import BulkWriteError, ConnectionFailure, PyMongoError
 from itemadapter import ItemAdapter
+from scrapy.exceptions import NotConfigured
 from bson.objectid import ObjectId
+from twisted.internet import defer, task
 
-BUFFER_SIZE = 100
+from zjlibpd_crawler.fingerprints import sized_fingerprint
+from zjlibpd_crawler.segments import SegmentWriter
+from zjlibpd_crawler.staging import StagingStore
+from zjlibpd_crawler.store import ItemStore
+
+BUFFER_SIZE = 100  # documents per batch to start with, adapted to the bulk_write time
+MAX_BUFFER_SIZE = 10000
+# server error codes of writes worth retrying, e.g. on elections or timeouts, unlike
+# duplicate keys or failed validation which fail again the same way
+TRANSIENT_WRITE_ERRORS = frozenset(
+    {6, 7, 50, 89, 91, 112, 189, 262, 9001, 10107, 11600, 11602, 13435, 13436}
+)
 
 
 class ZjlibpdCrawlerPipeline:
@@ -20,53 +38,456 @@ class ZjlibpdCrawlerPipeline:
         return item
 
 
+class ItemStorePipeline:
+    """Upsert items into the SQLite item store at ITEM_STORE (see zjlibpd_crawler.store)"""
+
+    commit_interval = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not (path := crawler.settings.get("ITEM_STORE")):
+            raise NotConfigured
+        return cls(path)
+
+    def open_spider(self, spider):
+        self.store = ItemStore(self.path)
+        spider.log(
+            f"ItemStorePipeline opened {self.path} with {self.store.count()} items"
+        )
+
+    def close_spider(self, spider):
+        self.store.close()
+
+    def process_item(self, item, spider):
+        self.store.put(ItemAdapter(item).asdict())
+        self.pending += 1
+        if self.pending >= self.commit_interval:
+            self.store.commit()
+            self.pending = 0
+        return item
+
+
+class SegmentedFeedPipeline:
+    """Write items to compressed, size-rotated segments in SEGMENTED_FEED_DIR
+
+    See zjlibpd_crawler.segments for the layout and for reading single items back.
+    """
+
+    def __init__(self, directory, max_segment_bytes, compression):
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.compression = compression
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not (directory := crawler.settings.get("SEGMENTED_FEED_DIR")):
+            raise NotConfigured
+        return cls(
+            directory,
+            crawler.settings.getint("SEGMENTED_FEED_MAX_BYTES", 256 * 1024 * 1024),
+            crawler.settings.get("SEGMENTED_FEED_COMPRESSION"),
+        )
+
+    def open_spider(self, spider):
+        self.writer = SegmentWriter(
+            self.directory, self.max_segment_bytes, self.compression
+        )
+        spider.log(
+            f"SegmentedFeedPipeline writing {self.writer.compression} segments to {self.directory}"
+        )
+
+    def close_spider(self, spider):
+        self.writer.close()
+
+    def process_item(self, item, spider):
+        self.writer.write(ItemAdapter(item).asdict())
+        return item
+
+
+class JoinPipeline:
+    """Join volumes to their books as they arrive, writing one record per book to JOIN_FEED
+
+    A record is the top-level item with its volumes (the items crawled for the ids in its
+    `sub_resources`, in that order) under `__SUBS__`. Volumes are matched by id rather than
+    by `__PARENT__`, as volumes shared by several books are only crawled once. Books wait
+    for their volumes, and volumes for their books, in StagingStores which spill to disk.
+
+    Volumes the spider skipped as an earlier run fetched them (FETCHED_IDS, DELTA_INDEX) are
+    not waited for: they are taken from ITEM_STORE if it has them, and listed under
+    `__SKIPPED__` otherwise. Books still incomplete when the crawl ends, e.g. as some
+    volumes were broken, are written anyway, with the ids not crawled under `__MISSING__`,
+    and so are volumes whose book never arrived. Items pass through unchanged.
+    """
+
+    def __init__(self, path, max_in_memory, item_store=None):
+        self.path = path
+        self.max_in_memory = max_in_memory
+        self.item_store = item_store
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not (path := crawler.settings.get("JOIN_FEED")):
+            raise NotConfigured
+        return cls(
+            path,
+            crawler.settings.getint("STAGING_MEMORY_ITEMS", 10000),
+            crawler.settings.get("ITEM_STORE"),
+        )
+
+    def open_spider(self, spider):
+        # books waiting for volumes, and the ids of the books waiting for each volume
+        self.groups = StagingStore(max_in_memory=self.max_in_memory)
+        self.waiting = {}
+        # volumes crawled so far, as books listing them may still arrive
+        self.volumes = StagingStore(max_in_memory=self.max_in_memory)
+        self.parent_ids = set()
+        self.store = ItemStore(self.item_store) if self.item_store else None
+        self.file = open(self.path, "a", encoding="utf-8")
+
+    def close_spider(self, spider):
+        incomplete = self.groups.keys()
+        if incomplete:
+            spider.logger.warning(
+                f"Writing {len(incomplete)} incomplete books to {self.path}"
+            )
+        for key in incomplete:
+            self._write(self.groups.pop(key), spider)
+        # volumes of books which were not crawled
+        orphans = {}
+        for id in self.volumes.keys():
+            volume = self.volumes.get(id)
+            if volume["__PARENT__"] not in self.parent_ids:
+                orphans.setdefault(volume["__PARENT__"], {})[id] = volume
+        for parent_id, subs in orphans.items():
+            self._write({"parent": None, "subs": subs, "skipped": []}, spider)
+        self.groups.close()
+        self.volumes.close()
+        if self.store is not None:
+            self.store.close()
+        self.file.close()
+
+    def process_item(self, item, spider):
+        item = ItemAdapter(item).asdict()
+        if item.get("__PARENT__"):
+            self.volumes.put(item["id"], item)
+            for parent_id in self.waiting.pop(item["id"], ()):
+                group = self.groups.get(parent_id)
+                group["subs"][item["id"]] = item
+                self._update(parent_id, group, spider)
+            return item
+
+        group = {"parent": item, "subs": {}, "skipped": []}
+        self.parent_ids.add(item["id"])
+        skipped_ids = getattr(spider, "skipped_ids", ())
+        for id in missing_subs(group):
+            if (volume := self.volumes.get(id)) is None and id in skipped_ids:
+                if self.store is None or (volume := self.store.get(id)) is None:
+                    group["skipped"].append(id)
+                    spider.crawler.stats.inc_value("join/skipped_subs")
+                    continue
+            if volume is not None:
+                group["subs"][id] = volume
+        self._update(item["id"], group, spider)
+        return item
+
+    def _update(self, parent_id, group, spider):
+        if missing := missing_subs(group):
+            for id in missing:
+                self.waiting.setdefault(id, set()).add(parent_id)
+            self.groups.put(parent_id, group)
+        else:
+            self.groups.pop(parent_id)
+            self._write(group, spider)
+
+    def _write(self, group, spider):
+        subs = group["subs"]
+        if parent := group["parent"]:
+            ids = [sub["id"] for sub in parent.get("sub_resources", [])]
+            record = dict(parent, __SUBS__=[subs[id] for id in ids if id in subs])
+            if group["skipped"]:
+                record["__SKIPPED__"] = group["skipped"]
+        else:
+            # only volumes were crawled
+            parent_id = next(iter(subs.values()))["__PARENT__"]
+            record = {"id": parent_id, "__SUBS__": list(subs.values())}
+        if missing := missing_subs(group):
+            record["__MISSING__"] = missing
+            spider.crawler.stats.inc_value("join/incomplete_books")
+        else:
+            spider.crawler.stats.inc_value("join/books")
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def missing_subs(group):
+    """Ids of the book and volumes of a group that have not arrived (nor been skipped)"""
+    if (parent := group["parent"]) is None:
+        return [next(iter(group["subs"].values()))["__PARENT__"]]
+    # sometimes, the parent resource is included as a sub resource of itself
+    return [
+        sub["id"]
+        for sub in parent.get("sub_resources", [])
+        if sub["id"] != parent["id"]
+        and sub["id"] not in group["subs"]
+        and sub["id"] not in group["skipped"]
+    ]
+
+
 class MongoPipeline:
+    """Upsert items into MongoDB in batches
+
+    Batches are written by a background thread, so that the reactor never waits on the
+    database. At most MONGO_WRITE_QUEUE_SIZE batches are queued; beyond that, items are
+    held back until the writer catches up. Writes failing with transient errors are retried
+    up to MONGO_WRITE_RETRIES times, others are given up on right away.
+
+    Items identical to the stored documents are not written at all: documents carry a
+    `_hash` of their content, which is loaded for the whole collection on open, and a
+    `last_changed` time which is only updated when that hash changes. Hashes are recorded
+    once their documents are written, so that items which failed to write are retried the
+    next time they are crawled.
+
+    A batch is flushed once its items add up to MONGO_BATCH_MAX_BYTES, measured as the JSON
+    their hashes are computed from, once its oldest item has waited MONGO_BATCH_MAX_LATENCY
+    seconds, or once it has as many documents as currently allowed. The number of documents
+    allowed starts at BUFFER_SIZE and is doubled or halved to keep each bulk_write around
+    MONGO_BATCH_TARGET_TIME seconds.
+    """
+
     collection_name = "items"
 
-    def __init__(self, mongo_uri, mongo_db):
+    def __init__(
+        self,
+        mongo_uri,
+        mongo_db,
+        stats,
+        queue_size=8,
+        retries=3,
+        max_bytes=8 * 1024 * 1024,
+        max_latency=10.0,
+        target_time=1.0,
+    ):
         self.mongo_uri = mongo_uri
         self.mongo_db = mongo_db
+        self.stats = stats
+        self.queue = queue.Queue()
+        # taken by each queued batch and given back by the writer, so that the reactor waits
+        # for room in the queue without blocking a thread
+        self.slots = defer.DeferredSemaphore(queue_size)
+        self.retries = retries
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self.target_time = target_time
+        # adjusted by the writer thread
+        self.buffer_size = BUFFER_SIZE
         self.buffer = []
+        self.buffer_bytes = 0
+        self.buffer_since = None
 
     @classmethod
     def from_crawler(cls, crawler):
         return cls(
             mongo_uri=crawler.settings.get("MONGO_URI"),
             mongo_db=crawler.settings.get("MONGO_DATABASE", "zjlibpd"),
+            stats=crawler.stats,
+            queue_size=crawler.settings.getint("MONGO_WRITE_QUEUE_SIZE", 8),
+            retries=crawler.settings.getint("MONGO_WRITE_RETRIES", 3),
+            max_bytes=crawler.settings.getint("MONGO_BATCH_MAX_BYTES", 8 * 1024 * 1024),
+            max_latency=crawler.settings.getfloat("MONGO_BATCH_MAX_LATENCY", 10.0),
+            target_time=crawler.settings.getfloat("MONGO_BATCH_TARGET_TIME", 1.0),
         )
 
     def open_spider(self, spider):
-        spider.log(f"MongoPipeline BUFFER_SIZE={BUFFER_SIZE}")
+        spider.log(
+            f"MongoPipeline BUFFER_SIZE={BUFFER_SIZE} max_bytes={self.max_bytes} max_latency={self.max_latency}"
+        )
         self.client = pymongo.MongoClient(self.mongo_uri)
         self.db = self.client[self.mongo_db]
+        self.hashes = {
+            doc["_id"]: doc.get("_hash")
+            for doc in self.db[self.collection_name].find({}, {"_hash": 1})
+        }
+        spider.log(f"MongoPipeline loaded hashes of {len(self.hashes)} documents")
+        self.writer = threading.Thread(
+            target=self._write_batches,
+            args=(spider,),
+            name="MongoPipeline",
+            daemon=True,
+        )
+        self.writer.start()
+        self.timer = task.LoopingCall(self._flush_stale_buffer)
+        self.timer.start(max(self.max_latency / 4, 0.1), now=False)
 
     def close_spider(self, spider):
-        count = 0
-        self.db[self.collection_name].bulk_write(self.buffer, ordered=False)
-        self.buffer = []
-        # while (e := self._try_flush_buffer(spider)) and count < 1:
-        #     spider.logger.info(f"Retrying to flush buffer")
-        #     count += 1
-        # if e:
-        #     raise e
-
-        self.client.close()
+        self.timer.stop()
+        if self.buffer:
+            self.stats.inc_value("mongo/flush/close")
+            self._flush_buffer()
+        # after the batches still waiting for a slot
+        d = self.slots.run(self.queue.put, None)
+        # everything queued is written before the client is closed
+        d.addCallback(lambda _: self.writer.join())
+        d.addCallback(lambda _: self.client.close())
+        return d
 
     def process_item(self, item, spider):
         item = ItemAdapter(item).asdict()
+        hash, size = sized_fingerprint(item)
         item["_id"] = ObjectId(item["id"])
         del item["id"]
-        req = ReplaceOne({"_id": item["_id"]}, item, upsert=True)
+        if self.hashes.get(item["_id"]) == hash:
+            self.stats.inc_value("mongo/unchanged_documents")
+            return item
+        item["_hash"] = hash
+        item["last_changed"] = datetime.datetime.now(datetime.timezone.utc)
         # self.db[self.collection_name].replace_one({'_id': item['_id']}, item, upsert=True)
-        self.buffer.append(req)
-
-        if len(self.buffer) >= BUFFER_SIZE:
-            # self._try_flush_buffer(spider)
-            self.db[self.collection_name].bulk_write(self.buffer, ordered=False)
-            self.buffer = []
+        if not self.buffer:
+            self.buffer_since = time.monotonic()
+        self.buffer.append(item)
+        self.buffer_bytes += size
 
+        if self.buffer_bytes >= self.max_bytes:
+            self.stats.inc_value("mongo/flush/bytes")
+        elif len(self.buffer) >= self.buffer_size:
+            self.stats.inc_value("mongo/flush/size")
+        else:
+            return item
+        if d := self._flush_buffer():
+            # backpressure: the item is done only once its batch is queued, and
+            # Scrapy stops feeding responses to the spider meanwhile
+            d.addCallback(lambda _: item)
+            return d
         return item
 
+    def _flush_stale_buffer(self):
+        if self.buffer and time.monotonic() - self.buffer_since >= self.max_latency:
+            self.stats.inc_value("mongo/flush/latency")
+            self._flush_buffer()
+
+    def _flush_buffer(self):
+        """Queue the buffer for the writer, returning a Deferred if it has to wait"""
+        batch = self._take_buffer()
+        if not self.slots.tokens:
+            self.stats.inc_value("mongo/queue_full")
+        d = self.slots.acquire()
+        d.addCallback(lambda _: self.queue.put(batch))
+        if not d.called:
+            return d
+
+    def _take_buffer(self):
+        batch = (self.buffer, self.buffer_bytes)
+        self.buffer = []
+        self.buffer_bytes = 0
+        return batch
+
+    def _write_batches(self, spider):
+        from twisted.internet import reactor
+
+        while (batch := self.queue.get()) is not None:
+            documents, size = batch
+            start = time.perf_counter()
+            try:
+                written = self._write_batch(documents, spider)
+            except Exception:
+                spider.logger.exception(
+                    f"Failed to write {len(documents)} items to MongoDB"
+                )
+                self.stats.inc_value("mongo/failed_documents", len(documents))
+                written = []
+            for document in written:
+                self.hashes[document["_id"]] = document["_hash"]
+            self.stats.inc_value("mongo/bytes", size)
+            self._adapt(len(documents), time.perf_counter() - start)
+            reactor.callFromThread(self.slots.release)
+
+    def _adapt(self, count, elapsed):
+        """Scale the documents per batch by how long writing the last batch took"""
+        if count < self.buffer_size:
+            # flushed early, by bytes or latency: says nothing about larger batches
+            if elapsed > self.target_time:
+                self.buffer_size = max(count // 2, 1)
+        elif elapsed > self.target_time:
+            self.buffer_size = max(self.buffer_size // 2, 1)
+        elif elapsed < self.target_time / 2:
+            self.buffer_size = min(self.buffer_size * 2, MAX_BUFFER_SIZE)
+        self.stats.set_value("mongo/buffer_size", self.buffer_size)
+        if write_time := self.stats.get_value("mongo/bulk_write_time"):
+            self.stats.set_value(
+                "mongo/documents_per_sec",
+                self.stats.get_value("mongo/documents", 0) / write_time,
+            )
+            self.stats.set_value(
+                "mongo/bytes_per_sec",
+                self.stats.get_value("mongo/bytes", 0) / write_time,
+            )
+
+    def _write_batch(self, batch, spider):
+        """Upsert a batch of documents, retrying only the ones that failed transiently;
+        returns the written ones"""
+        collection = self.db[self.collection_name]
+        written = []
+        rejected = 0
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(min(2**attempt, 30))
+                self.stats.inc_value("mongo/retried_documents", len(batch))
+            start = time.perf_counter()
+            try:
+                collection.bulk_write(
+                    [
+                        ReplaceOne({"_id": doc["_id"]}, doc, upsert=True)
+                        for doc in batch
+                    ],
+                    ordered=False,
+                )
+            except BulkWriteError as e:
+                errors = e.details["writeErrors"]
+                spider.logger.warning(
+                    f"{len(errors)} of {len(batch)} writes to MongoDB failed: {e}"
+                )
+                failed = {error["index"] for error in errors}
+                transient = sorted(
+                    error["index"]
+                    for error in errors
+                    if error.get("code") in TRANSIENT_WRITE_ERRORS
+                )
+                written.extend(doc for i, doc in enumerate(batch) if i not in failed)
+                rejected += len(failed) - len(transient)
+                batch = [batch[i] for i in transient]
+            except PyMongoError as e:
+                spider.logger.warning(
+                    f"Failed to write {len(batch)} items to MongoDB: {e!r}"
+                )
+                if not self._is_transient(e):
+                    rejected += len(batch)
+                    batch = []
+            else:
+                written.extend(batch)
+                batch = []
+            self.stats.inc_value("mongo/bulk_write_time", time.perf_counter() - start)
+            self.stats.inc_value("mongo/bulk_write_count")
+            if not batch:
+                break
+        else:
+            # still failing after all retries
+            rejected += len(batch)
+        if rejected:
+            spider.logger.error(f"Gave up writing {rejected} items to MongoDB")
+            self.stats.inc_value("mongo/failed_documents", rejected)
+        self.stats.inc_value("mongo/documents", len(written))
+        return written
+
+    @staticmethod
+    def _is_transient(e):
+        return (
+            isinstance(e, ConnectionFailure)
+            or e.has_error_label("RetryableWriteError")
+            or getattr(e, "code", None) in TRANSIENT_WRITE_ERRORS
+        )
+
     # def _try_flush_buffer(self, spider):
     #     if self.buffer:
     #         try:
@@ -0,0 +1,185 @@
+"""Compressed, size-rotated JSON lines segments with an id -> offset index
+
+Items are written to DIR/items-NNNNN.jsonl.zst (or .gz) in blocks of about BLOCK_SIZE
+bytes, each block being a complete zstd frame (or gzip member). Concatenated frames are
+still a valid file, so a segment can be decompressed as a whole by zstdcat/zcat, while a
+single item is read by seeking to its block and decompressing only that.
+
+DIR/items.idx has a line `id<TAB>segment<TAB>block offset<TAB>line offset` per item, where
+the line offset is relative to the decompressed block. Later lines override earlier ones
+for re-crawled items. zstd needs the optional `zstandard` package; gzip is used otherwise.
+
+Usage: python -m zjlibpd_crawler.segments DIR [ID ...]
+streams all items (or the given ones) to stdout as JSON lines.
+"""
+
+import gzip
+import io
+import json
+import re
+import sys
+import zlib
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BLOCK_SIZE = 1024 * 1024  # uncompressed bytes per block
+INDEX_NAME = "items.idx"
+SEGMENT_PATTERN = re.compile(r"items-(\d+)\.jsonl\.(zst|gz)")
+
+
+def default_compression():
+    return "zstd" if zstandard is not None else "gzip"
+
+
+class SegmentWriter:
+
+    def __init__(
+        self, directory, max_segment_bytes=256 * 1024 * 1024, compression=None
+    ):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_segment_bytes = max_segment_bytes
+        self.compression = compression or default_compression()
+        if self.compression == "zstd":
+            if zstandard is None:
+                raise ImportError("zstd compression requires the zstandard package")
+            self.compressor = zstandard.ZstdCompressor(level=10)
+        elif self.compression != "gzip":
+            raise ValueError(f"Unknown compression {self.compression}")
+        # never append to existing segments: carry on with the next one
+        numbers = [
+            int(m.group(1))
+            for path in self.directory.iterdir()
+            if (m := SEGMENT_PATTERN.fullmatch(path.name))
+        ]
+        self.segment_number = max(numbers, default=-1) + 1
+        self.segment = None
+        self.index = open(self.directory / INDEX_NAME, "a", encoding="utf-8")
+        self.block = []
+        self.block_ids = []
+        self.block_size = 0
+
+    def write(self, item):
+        line = json.dumps(item, ensure_ascii=False).encode("utf-8") + b"\n"
+        self.block_ids.append((item["id"], self.block_size))
+        self.block.append(line)
+        self.block_size += len(line)
+        if self.block_size >= BLOCK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.block:
+            return
+        if self.segment is None:
+            extension = "zst" if self.compression == "zstd" else "gz"
+            self.segment_name = f"items-{self.segment_number:05}.jsonl.{extension}"
+            self.segment = open(self.directory / self.segment_name, "wb")
+        data = b"".join(self.block)
+        if self.compression == "zstd":
+            compressed = self.compressor.compress(data)
+        else:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            compressed = compressor.compress(data) + compressor.flush()
+        offset = self.segment.tell()
+        self.segment.write(compressed)
+        self.segment.flush()
+        # the index only ever points to blocks already written
+        self.index.writelines(
+            f"{id}\t{self.segment_name}\t{offset}\t{line_offset}\n"
+            for id, line_offset in self.block_ids
+        )
+        self.index.flush()
+        self.block = []
+        self.block_ids = []
+        self.block_size = 0
+        if self.segment.tell() >= self.max_segment_bytes:
+            self.segment.close()
+            self.segment = None
+            self.segment_number += 1
+
+    def close(self):
+        self.flush()
+        if self.segment is not None:
+            self.segment.close()
+        self.index.close()
+
+
+class SegmentReader:
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.index = {}
+        with open(self.directory / INDEX_NAME, encoding="utf-8") as f:
+            for line in f:
+                id, segment, block_offset, line_offset = line.rstrip("\n").split("\t")
+                self.index[id] = (segment, int(block_offset), int(line_offset))
+        # the last decompressed block, as neighbouring items are often read together
+        self.cached_block = (None, None)
+
+    def __contains__(self, id):
+        return id in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, id, default=None):
+        if (location := self.index.get(id)) is None:
+            return default
+        segment, block_offset, line_offset = location
+        if self.cached_block[0] != (segment, block_offset):
+            self.cached_block = (
+                (segment, block_offset),
+                self._read_block(segment, block_offset),
+            )
+        block = self.cached_block[1]
+        return json.loads(block[line_offset : block.index(b"\n", line_offset)])
+
+    def __iter__(self):
+        """All items in the order they were written, including superseded ones"""
+        for path in sorted(self.directory.glob("items-*.jsonl.*")):
+            with self._open_segment(path) as f:
+                for line in f:
+                    yield json.loads(line)
+
+    def _read_block(self, segment, offset):
+        with open(self.directory / segment, "rb") as f:
+            f.seek(offset)
+            decompressor = self._decompressor(segment)
+            chunks = []
+            while not decompressor.eof and (data := f.read(64 * 1024)):
+                chunks.append(decompressor.decompress(data))
+        return b"".join(chunks)
+
+    def _open_segment(self, path):
+        if path.name.endswith(".zst"):
+            if zstandard is None:
+                raise ImportError(f"{path.name} requires the zstandard package")
+            return io.BufferedReader(
+                zstandard.ZstdDecompressor().stream_reader(
+                    open(path, "rb"), read_across_frames=True, closefd=True
+                )
+            )
+        return gzip.open(path)
+
+    def _decompressor(self, segment):
+        if segment.endswith(".zst"):
+            if zstandard is None:
+                raise ImportError(f"{segment} requires the zstandard package")
+            return zstandard.ZstdDecompressor().decompressobj()
+        return zlib.decompressobj(31)
+
+
+def main():
+    reader = SegmentReader(sys.argv[1])
+    items = (reader.get(id) for id in sys.argv[2:]) if sys.argv[2:] else reader
+    for item in items:
+        if item is not None:
+            sys.stdout.write(json.dumps(item, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -44,28 +44,43 @@ ROBOTSTXT_OBEY = True
 
 # Enable or disable spider middlewares
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-# SPIDER_MIDDLEWARES = {
-#    "zjlibpd_crawler.middlewares.ZjlibpdCrawlerSpiderMiddleware": 543,
-# }
+SPIDER_MIDDLEWARES = {
+    #    "zjlibpd_crawler.middlewares.ZjlibpdCrawlerSpiderMiddleware": 543,
+    # enabled by BACKLOG_LIMIT
+    "zjlibpd_crawler.middlewares.BacklogLimitMiddleware": 40,
+    "zjlibpd_crawler.middlewares.CallbackStatsMiddleware": 1000,
+}
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-# DOWNLOADER_MIDDLEWARES = {
-#    "zjlibpd_crawler.middlewares.ZjlibpdCrawlerDownloaderMiddleware": 543,
-# }
+DOWNLOADER_MIDDLEWARES = {
+    #    "zjlibpd_crawler.middlewares.ZjlibpdCrawlerDownloaderMiddleware": 543,
+    # enabled by RESPONSE_CACHE_DIR; below HttpCompressionMiddleware (590), so that
+    # decoded bodies are cached
+    "zjlibpd_crawler.middlewares.ResponseCacheMiddleware": 575,
+    # enabled by ADAPTIVE_CONCURRENCY_ENABLED; also below HttpCompressionMiddleware, to
+    # check the code of decoded listing payloads
+    "zjlibpd_crawler.middlewares.AdaptiveConcurrencyMiddleware": 585,
+}
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
-# EXTENSIONS = {
-#    "scrapy.extensions.telnet.TelnetConsole": None,
-# }
+EXTENSIONS = {
+    #    "scrapy.extensions.telnet.TelnetConsole": None,
+    # enabled by STATS_EXPORT_JSON or STATS_EXPORT_PROMETHEUS
+    "zjlibpd_crawler.extensions.StatsExporter": 500,
+}
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
-# ITEM_PIPELINES = {
-#     #    "zjlibpd_crawler.pipelines.ZjlibpdCrawlerPipeline": 300,
-#     "zjlibpd_crawler.pipelines.MongoPipeline": 300,
-# }
+ITEM_PIPELINES = {
+    #    "zjlibpd_crawler.pipelines.ZjlibpdCrawlerPipeline": 300,
+    # only enabled if ITEM_STORE / SEGMENTED_FEED_DIR / JOIN_FEED is set
+    "zjlibpd_crawler.pipelines.ItemStorePipeline": 200,
+    "zjlibpd_crawler.pipelines.SegmentedFeedPipeline": 210,
+    "zjlibpd_crawler.pipelines.JoinPipeline": 220,
+    # "zjlibpd_crawler.pipelines.MongoPipeline": 300,
+}
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
@@ -94,3 +109,82 @@ TWISTED_REACTOR = "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
 FEED_EXPORT_ENCODING = "utf-8"
 
 URLLENGTH_LIMIT = 8192
+
+# Listing pages (search-list) in flight once the first page reports totalPages;
+# 0 schedules all remaining pages up front, N keeps a sliding window of N pages
+# LISTING_PAGE_WINDOW = 0
+
+# Probe the largest pageSize search-list honours (see PAGE_SIZES in the spider) and
+# fall back to smaller sizes on errors or truncated pages
+# LISTING_PAGE_SIZE_PROBE = False
+
+# Listings with more records than the API serves are split into shards by the
+# classifies facets, in order, until each shard fits (see SHARD_FACETS in the spider)
+# LISTING_RECORD_LIMIT = 100000
+# LISTING_SHARD_FACETS = {"left_letter": ["a", "b", ..., "z", "other"]}
+
+# Delta crawl: fingerprints of listing records are kept in this file across runs,
+# and only new or changed resources get their details and reader pages requested
+# DELTA_INDEX = "crawls/fingerprints.tsv"
+
+# Cache details and reader pages on disk, keyed by resource id / reader URL, so that
+# fixes to the parsing callbacks can be re-run offline
+# RESPONSE_CACHE_DIR = "crawls/responses"
+# RESPONSE_CACHE_EXPIRATION_SECS = 0
+# RESPONSE_CACHE_MAX_BYTES = 0
+
+# Hold back listing pages while this many requests are already scheduled or downloading,
+# which keeps memory flat on large listings; 0 disables it
+# BACKLOG_LIMIT = 0
+
+# Resources fetched by previous runs are recorded in this file, and volumes listed in
+# sub_resources are not requested again once they are in it
+# FETCHED_IDS = "crawls/fetched.ids"
+
+# Tune the concurrency of listing, details and reader requests separately, based on their
+# latency and error rates (raise CONCURRENT_REQUESTS accordingly)
+# ADAPTIVE_CONCURRENCY_ENABLED = False
+# ADAPTIVE_CONCURRENCY_START = 4
+# ADAPTIVE_CONCURRENCY_MAX = 32
+# ADAPTIVE_CONCURRENCY_TARGET_LATENCY = 2.0
+# ADAPTIVE_CONCURRENCY_MAX_ERROR_RATE = 0.05
+# ADAPTIVE_CONCURRENCY_WINDOW = 20
+
+# Periodically write crawl stats (incl. per-callback CPU time, items/sec and queue depth)
+# to a JSON file and/or a Prometheus textfile
+# STATS_EXPORT_JSON = "crawls/stats.json"
+# STATS_EXPORT_PROMETHEUS = "crawls/zjlibpd.prom"
+# STATS_EXPORT_INTERVAL = 60
+
+# MongoPipeline writes batches from a background thread; at most this many batches wait
+# for it before items are held back, and writes failing with transient errors are retried
+# this many times
+# MONGO_WRITE_QUEUE_SIZE = 8
+# MONGO_WRITE_RETRIES = 3
+
+# MongoPipeline batches are flushed at this many bytes (of the items as JSON) or once their
+# oldest item is this many seconds old; the documents per batch adapt to keep bulk_write
+# near the target time
+# MONGO_BATCH_MAX_BYTES = 8388608
+# MONGO_BATCH_MAX_LATENCY = 10.0
+# MONGO_BATCH_TARGET_TIME = 1.0
+
+# Also keep items in an SQLite file keyed by resource id, replacing re-crawled ones (see
+# zjlibpd_crawler/store.py for lookups and exporting it as JSON lines)
+# ITEM_STORE = "items.sqlite"
+
+# Also write items to zstd (if the zstandard package is installed) or gzip compressed
+# segments rotated at the given size, with an id -> offset index for reading single items
+# back (see zjlibpd_crawler/segments.py)
+# SEGMENTED_FEED_DIR = "crawls/items"
+# SEGMENTED_FEED_MAX_BYTES = 268435456
+# SEGMENTED_FEED_COMPRESSION = "zstd"
+
+# Also write one JSON line per book, with the items of its volumes under __SUBS__, as soon
+# as all of them are crawled (books incomplete at the end list the rest under __MISSING__);
+# volumes fetched by earlier runs are taken from ITEM_STORE, or listed under __SKIPPED__
+# JOIN_FEED = "books.jsonl"
+
+# Items staged in memory (e.g. listing records awaiting their details, books awaiting
+# their volumes) before older ones are spilled to an SQLite file
+# STAGING_MEMORY_ITEMS = 10000
@@ -1,15 +1,29 @@
 from typing import Iterable
 import scrapy
-from scrapy import Request
+from scrapy import Request, signals
 from scrapy.http import JsonRequest, Response
 import json
 import re
+import functools
 from ast import literal_eval
+from pathlib import Path
 import json
-from mergedeep import merge, Strategy
 from urllib.parse import urlparse, urljoin, parse_qs
 
+from zjlibpd_crawler.fingerprints import FingerprintIndex, fingerprint
+from zjlibpd_crawler.idset import ResourceIdSet
+from zjlibpd_crawler.merge import merge_resource
+from zjlibpd_crawler.staging import StagingStore
+
 PAGE_SIZE = 10
+# candidates probed for search-list when LISTING_PAGE_SIZE_PROBE is on, largest first;
+# each one divides the previous so that a rejected page maps onto whole smaller pages
+PAGE_SIZES = (100, 50, PAGE_SIZE)
+RECORD_LIMIT = 100000  # the API limit on totalRecords of a single listing
+# filters that a listing over RECORD_LIMIT is split by, tried in order
+SHARD_FACETS = {
+    "left_letter": list("abcdefghijklmnopqrstuvwxyz") + ["other"],
+}
 
 
 # TODO:
@@ -20,6 +34,8 @@ class BooksSpider(scrapy.Spider):
     name = "books"
     allowed_domains = ["zjlib.cn"]
     start_urls = ["https://zjlib.cn"]
+    # can be overridden with `-a base_url=...`, e.g. to crawl a local stand-in of the site
+    base_url = "https://history.zjlib.cn"
 
     custom_settings = {
         "ROBOTSTXT_OBEY": False,
@@ -33,32 +49,120 @@ class BooksSpider(scrapy.Spider):
         },
     }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not (host := urlparse(self.base_url).hostname).endswith("zjlib.cn"):
+            self.allowed_domains = [host]
+        # ids requested so far, as shards (and parents sharing volumes) may overlap
+        self.seen_ids = set()
+        # volumes not requested as an earlier run fetched them, for JoinPipeline
+        self.skipped_ids = set()
+        self.delta = None
+        self.fetched_ids = None
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.spider_opened, signal=signals.spider_opened)
+        return spider
+
+    def spider_opened(self, spider):
+        # set up here rather than in start_requests, as a crawl resumed from JOBDIR may run
+        # the callbacks of queued requests before start_requests is consumed
+        if self.settings.getbool("LISTING_PAGE_SIZE_PROBE"):
+            self.page_sizes = PAGE_SIZES
+        else:
+            self.page_sizes = (PAGE_SIZE,)
+        self.record_limit = self.settings.getint("LISTING_RECORD_LIMIT", RECORD_LIMIT)
+        self.shard_facets = self.settings.getdict("LISTING_SHARD_FACETS", SHARD_FACETS)
+        # listing records waiting for their details pages ("page:<id>") and items waiting
+        # for their reader pages ("reader:<id>"), so that requests only carry ids
+        jobdir = self.settings.get("JOBDIR")
+        self.staging = StagingStore(
+            Path(jobdir) / "staging.sqlite" if jobdir else None,
+            self.settings.getint("STAGING_MEMORY_ITEMS", 10000),
+        )
+        if fetched_ids := self.settings.get("FETCHED_IDS"):
+            # resources fetched by any previous run, volumes among them are not requested again
+            self.fetched_ids = ResourceIdSet(fetched_ids)
+            self.log(
+                f"Loaded {self.fetched_ids.count()} fetched ids from {fetched_ids}"
+            )
+        if delta_index := self.settings.get("DELTA_INDEX"):
+            # only request items whose listing record changed since the last run
+            self.delta = FingerprintIndex(
+                delta_index, Path(jobdir) / "delta.pending" if jobdir else None
+            )
+            self.log(
+                f"Loaded {len(self.delta.fingerprints)} fingerprints from {delta_index}"
+                f" ({len(self.delta.pending)} pending)"
+            )
+
     def start_requests(self) -> Iterable[Request]:
-        # for i, left_letter in enumerate(list("abcdefghijklmnopqrstuvwxyz") + ["other"]):
-        #     prio = (1 << 10) - 1 - i
-        #     yield self.request_page(
-        #         1,
-        #         left_letter=left_letter,
-        #         priority=prio,
-        #     )
         # yield self.request_item("62b5518e3157d263ee6a445e")
-        yield self.request_page(1, search_id=24016, priority=(1 << 10) - 1)
+        yield self.request_page(
+            1, page_size=self.page_sizes[0], search_id=24016, priority=(1 << 10) - 1
+        )
 
     def parse_page(self, response):
         page_no = response.meta["page_no"]
-        left_letter = response.meta["left_letter"]
+        page_size = response.meta["page_size"]
+        shard = response.meta["shard"]
         search_id = response.meta["search_id"]
         page_priority = response.meta.get("priority", 0)
         self.log(
-            f"Fetched page where page_no={page_no}, search_id={search_id}, left_letter={left_letter}, priority={page_priority}"
+            f"Fetched page where page_no={page_no}, page_size={page_size}, search_id={search_id}, shard={format_shard(shard)}, priority={page_priority}"
         )
 
-        d = json.loads(response.text)
-        assert d["code"] == 1, d
-        d = d["data"]
-        assert page_no == int(d["curPage"])
-        assert int(d["totalRecords"]) <= 100000  # the API limit
-        total_pages = int(d["totalPages"])
+        try:
+            d = json.loads(response.text)
+        except ValueError as e:
+            d = {"code": None, "error": repr(e)}
+        if (
+            d.get("code") == 1
+            and page_no == 1
+            and not response.meta.get("split")
+            and (total_records := int(d["data"]["totalRecords"])) > self.record_limit
+        ):
+            sub_shards = self.split_shard(shard)
+            assert (
+                sub_shards
+            ), f"No more facets to split shard={format_shard(shard)} with totalRecords={total_records}"
+            self.logger.info(
+                f"Splitting shard={format_shard(shard)} with totalRecords={total_records} into {len(sub_shards)}"
+            )
+            self.crawler.stats.inc_value("listing/shards", len(sub_shards))
+            for sub_shard in sub_shards:
+                # the same priority for all shards, so that their pages are interleaved
+                yield self.request_page(
+                    1,
+                    page_size=page_size,
+                    search_id=search_id,
+                    shard=sub_shard,
+                    priority=page_priority,
+                )
+            return
+        if problem := check_page(d, page_no, page_size):
+            if page_size > self.page_sizes[-1]:
+                yield from self.fall_back_page(response.request, problem)
+                return
+            self.logger.warning(
+                f"Inconsistent page where page_no={page_no}, page_size={page_size}: {problem}"
+            )
+        try:
+            assert d["code"] == 1, d
+            d = d["data"]
+            assert page_no == int(d["curPage"])
+            assert int(d["totalRecords"]) <= self.record_limit
+            total_pages = int(d["totalPages"])
+        except Exception:
+            # the page is lost, but the pages after it must still be requested
+            yield from self.skip_page(response.request)
+            raise
+
+        yield from self.fan_out_pages(
+            response.request, total_pages, int(d["totalRecords"])
+        )
 
         for i, item in enumerate(d["results"]):
             # Note:
@@ -66,34 +170,138 @@ class BooksSpider(scrapy.Spider):
             # sub_resources which are not present when requesting items seperately
             # so we request each item separately and merge them
             priority = (page_priority << 20) + (1 << 20) - 1 - i
-            self.log(
-                f"page_no={page_no}, search_id={search_id}, left_letter={left_letter}, i={i}, id={item['id']}, priority={page_priority}"
-            )
-            yield self.request_item(
-                item["id"],
-                meta={"item_on_page": item},
-                priority=priority,
-            )
+            if item["id"] in self.seen_ids:
+                self.crawler.stats.inc_value("listing/duplicate_ids")
+                continue
+            self.seen_ids.add(item["id"])
+            # sub resources are fingerprinted by the record of their parent
+            fp = self.delta and fingerprint(item)
+            if self.delta and self.delta.unchanged(item["id"], fp):
+                self.crawler.stats.inc_value("delta/unchanged")
+            else:
+                if self.delta:
+                    self.delta.expect(item["id"], fp)
+                self.log(
+                    f"page_no={page_no}, search_id={search_id}, shard={format_shard(shard)}, i={i}, id={item['id']}, priority={page_priority}"
+                )
+                self.staging.put(f"page:{item['id']}", item)
+                yield self.request_item(
+                    item["id"],
+                    meta={"merge": True},
+                    priority=priority,
+                )
 
             for sub in item.get("sub_resources", []):  # typically volumes of a book
                 # we also request items seperately for those listed in sub_resources, but we don't
                 # merge fields for them
                 # it is expected to be done externally
+                if sub["id"] in self.seen_ids:
+                    continue
+                self.seen_ids.add(sub["id"])
+                if self.fetched_ids is not None and sub["id"] in self.fetched_ids:
+                    self.crawler.stats.inc_value("listing/fetched_ids_skipped")
+                    self.skipped_ids.add(sub["id"])
+                    continue
+                if self.delta:
+                    if self.delta.unchanged(sub["id"], fp):
+                        self.crawler.stats.inc_value("delta/unchanged")
+                        self.skipped_ids.add(sub["id"])
+                        continue
+                    self.delta.expect(sub["id"], fp)
                 yield self.request_item(
                     sub["id"],
                     meta={"parent_id": item["id"]},
                     priority=priority,
                 )
 
-        if page_no < total_pages:
-            page_no += 1
-            priority = page_priority - 1
+    def fan_out_pages(self, request, total_pages, total_records):
+        # Pages after the first are fanned out instead of being chained one by one, so that the
+        # listing is fetched concurrently. With a window, page N keeps page N + window in flight.
+        meta = request.meta
+        if meta.get("split"):
+            # pages re-requested with a smaller size do not take part in the window
+            return
+        page_no = meta["page_no"]
+        window = self.settings.getint("LISTING_PAGE_WINDOW", 0)
+        if page_no == 1:
+            last = total_pages if window <= 0 else min(1 + window, total_pages)
+            next_pages = range(2, last + 1)
+        elif window > 0 and page_no + window <= total_pages:
+            next_pages = [page_no + window]
+        else:
+            next_pages = []
+        first_priority = meta.get("priority", 0) + page_no - 1
+        for next_page_no in next_pages:
+            yield self.request_page(
+                next_page_no,
+                page_size=meta["page_size"],
+                search_id=meta["search_id"],
+                shard=meta["shard"],
+                # pages in front are still preferred over pages behind
+                priority=first_priority - (next_page_no - 1),
+                meta={"total_pages": total_pages, "total_records": total_records},
+            )
+
+    def skip_page(self, request):
+        """Keep the window moving past a page that is given up on"""
+        if total_pages := request.meta.get("total_pages"):
+            yield from self.fan_out_pages(
+                request, total_pages, request.meta.get("total_records")
+            )
+
+    def fall_back_page(self, request, reason):
+        """Re-request the records of a rejected listing page with the next smaller page size"""
+        meta = request.meta
+        page_no, page_size = meta["page_no"], meta["page_size"]
+        smaller = next(s for s in self.page_sizes if s < page_size)
+        self.logger.info(
+            f"Falling back from page_size={page_size} to {smaller} for page_no={page_no}, search_id={meta['search_id']}, shard={format_shard(meta['shard'])}: {reason}"
+        )
+        self.crawler.stats.inc_value("listing/page_size_fallback")
+        kwargs = dict(
+            page_size=smaller,
+            search_id=meta["search_id"],
+            shard=meta["shard"],
+            priority=meta.get("priority", 0),
+        )
+        if page_no == 1 and not meta.get("split"):
+            # still probing: the first page decides the size of all the others
+            yield self.request_page(1, **kwargs)
+            return
+
+        factor = page_size // smaller
+        first = (page_no - 1) * factor + 1
+        last = first + factor - 1
+        if total_records := meta.get("total_records"):
+            last = min(last, -(-total_records // smaller))
+        for split_page_no in range(first, last + 1):
             yield self.request_page(
-                page_no,
-                search_id=search_id,
-                left_letter=response.meta["left_letter"],
-                priority=priority,
+                split_page_no,
+                meta={"split": True, "total_records": total_records},
+                **kwargs,
             )
+        # the window must keep moving even if this page is served by split pages
+        if total_pages := meta.get("total_pages"):
+            yield from self.fan_out_pages(request, total_pages, total_records)
+
+    def split_shard(self, shard):
+        """Narrow a shard down by the next facet not yet used in it"""
+        used = {pid for pid, _value in shard}
+        for pid, values in self.shard_facets.items():
+            if pid not in used:
+                return [shard + ((pid, value),) for value in values]
+        return []
+
+    def errback_page(self, failure):
+        request = failure.request
+        if request.meta["page_size"] > self.page_sizes[-1]:
+            yield from self.fall_back_page(request, repr(failure.value))
+        else:
+            self.logger.error(
+                f"Failed to fetch page where page_no={request.meta['page_no']}, search_id={request.meta['search_id']}, shard={format_shard(request.meta['shard'])}: {failure.value!r}"
+            )
+            self.crawler.stats.inc_value("listing/failed_pages")
+            yield from self.skip_page(request)
 
     def parse_item(self, response):
         parent_id = response.meta.get("parent_id")
@@ -105,9 +313,11 @@ class BooksSpider(scrapy.Spider):
             # sub resource
             # TODO: if sub_resources are also listed on pages, the flag set here might be overrided
             d["__PARENT__"] = parent_id
-        elif item_on_page := response.meta.get("item_on_page"):
+        elif response.meta.get("merge") and (
+            item_on_page := self.staging.pop(f"page:{response.meta['id']}")
+        ):
             # top-level resource
-            d = merge(d, item_on_page, strategy=Strategy.TYPESAFE_ADDITIVE)
+            d = merge_resource(d, item_on_page)
             d["__MERGED__"] = True
 
         for field in d["fields"]:
@@ -122,65 +332,127 @@ class BooksSpider(scrapy.Spider):
                     urls = [s["orsUrl"] for s in subs]
                 else:
                     urls = [field["orsUrl"]]
-                yield self.request_reader(urls, priority=priority, meta={"item": d})
+                yield from self.request_readers(d, urls, priority=priority)
 
                 break
         else:
-            yield d
+            yield self.complete_item(d)
 
     def parse_reader(self, response: Response):
-        priority = response.meta.get("priority", 0)
-        item = response.meta["item"]
-        left_urls = response.meta["urls"]
-
-        if (url := urlparse(response.url)).path.endswith("pdfjs/web/viewer.html"):
-            # only for id=62b5518e3157d263ee6a445e so far
-            reader = urljoin(response.url, parse_qs(url.query)["file"][0])
-        else:
-            metadata = json.loads(extract_var("readerObj", response.text))
-            total_pages = int(extract_var("pageNum", response.text))
-            dir_url = extract_var("imgUrl", response.text)
-            reader = {
-                "readerObj": metadata,
-                "pageNum": total_pages,
-                "imgUrl": dir_url,
-            }
-        item.setdefault("__READER__", []).append(reader)
-
-        if left_urls:
-            yield self.request_reader(left_urls, priority=priority, meta={"item": item})
-        else:
-            yield item
+        try:
+            if (url := urlparse(response.url)).path.endswith("pdfjs/web/viewer.html"):
+                # only for id=62b5518e3157d263ee6a445e so far
+                reader = urljoin(response.url, parse_qs(url.query)["file"][0])
+            else:
+                metadata, total_pages, dir_url = extract_vars(
+                    response.text, "readerObj", "pageNum", "imgUrl"
+                )
+                reader = {
+                    "readerObj": json.loads(metadata),
+                    "pageNum": int(total_pages),
+                    "imgUrl": dir_url,
+                }
+        except Exception:
+            # the item is still emitted with the other readers, but not marked as complete
+            self.logger.exception(f"Failed to parse reader {response.url}")
+            reader = None
+        yield from self.collect_reader(response.meta, reader)
         # assert dir_url.startswith("encodeURIComponent"), dir_url
         # dir_url = re.search(r'"(.+)"', dir_url).group(1)
         # assert dir_url.endswith("pdfImgaes/"), dir_url
         # dir_url = dir_url.removesuffix("pdfImgaes/") + meta['fileName'] + "." + meta['fileType']
 
-    def request_reader(self, urls, website_id=73953, **kwargs):
+    def errback_reader(self, failure):
+        self.logger.warning(
+            f"Failed to fetch reader {failure.request.url} of {failure.request.meta['item_id']}: {failure.value!r}"
+        )
+        yield from self.collect_reader(failure.request.meta, None)
+
+    def collect_reader(self, meta, reader):
+        """Put a reader into its slot and emit the item once all of its readers are settled
+
+        `reader` is None if it failed. The item is then emitted with None in its slot, as
+        consumers number the files of an item by the position of their readers, but it is
+        not marked as complete, so that later delta runs request it again.
+        """
+        pending = self.staging.get(f"reader:{meta['item_id']}")
+        pending["readers"][meta["reader_index"]] = reader
+        if reader is None:
+            pending["failed"].append(meta["reader_index"])
+        pending["left"] -= 1
+        if pending["left"]:
+            self.staging.put(f"reader:{meta['item_id']}", pending)
+            return
+        self.staging.pop(f"reader:{meta['item_id']}")
+        item = pending["item"]
+        item["__READER__"] = pending["readers"]
+        if failed := pending["failed"]:
+            self.logger.warning(
+                f"Readers {sorted(failed)} of {len(pending['readers'])} failed for {item['id']}, leaving it incomplete"
+            )
+            self.crawler.stats.inc_value("reader/incomplete_items")
+            yield item
+        else:
+            yield self.complete_item(item)
+
+    def complete_item(self, item):
+        if self.delta:
+            self.delta.complete(item["id"])
+        if self.fetched_ids is not None:
+            self.fetched_ids.add(item["id"])
+        return item
+
+    def closed(self, reason):
+        if left := self.staging.count():
+            self.log(f"{left} items left staged in {self.staging.path}")
+        self.staging.close()
+        if self.fetched_ids is not None:
+            self.fetched_ids.save()
+        if self.delta:
+            self.delta.save()
+            self.log(
+                f"Saved {len(self.delta.fingerprints)} fingerprints to {self.delta.path}"
+            )
+
+    def request_readers(self, item, urls, **kwargs):
+        """Request all reader pages of an item at once"""
+        pending = {
+            "item": item,
+            "readers": [None] * len(urls),
+            "failed": [],
+            "left": len(urls),
+        }
+        self.staging.put(f"reader:{item['id']}", pending)
+        for i, url in enumerate(urls):
+            yield self.request_reader(url, item["id"], i, **kwargs)
+
+    def request_reader(self, url, item_id, index, website_id=73953, **kwargs):
         meta = kwargs.setdefault("meta", {})
-        assert "item" in meta
-        assert "urls" not in meta
+        meta["item_id"] = item_id
+        meta["reader_index"] = index
         if priority := kwargs.get("priority"):
             meta["priority"] = priority
 
-        url = urls.pop(0)
-        meta["urls"] = urls
         return Request(
             url,
             cookies={"website_id": website_id},
             callback=self.parse_reader,
+            errback=self.errback_reader,
+            # the same file may be shared by volumes, but each of them is to be completed
+            dont_filter=True,
             **kwargs,
         )
 
     def request_item(self, id, **kwargs):
         meta = kwargs.get("meta", {})
+        meta["id"] = id
         if priority := kwargs.get("priority"):
             meta["priority"] = priority
         kwargs["meta"] = meta
 
         # pageId is used to render webpage, irrelevant to data
         return Request(
-            f"https://history.zjlib.cn/app/universal-search/resource/{id}/details?wfwfid=2120&searchId=0&params=&pageId=107556&classifyId=&classifyName=",
+            f"{self.base_url}/app/universal-search/resource/{id}/details?wfwfid=2120&searchId=0&params=&pageId=107556&classifyId=&classifyName=",
             # without this, probation=1 (trial mode) would be set by the server
             cookies={"website_id": 73953},
             callback=self.parse_item,
@@ -188,38 +460,78 @@ class BooksSpider(scrapy.Spider):
         )
 
     def request_page(
-        self, page_no=1, page_size=PAGE_SIZE, search_id=0, left_letter=None, **kwargs
+        self, page_no=1, page_size=PAGE_SIZE, search_id=0, shard=(), **kwargs
     ):
         # {"page":1,"pageSize":10,"wfwfid":"2120","sorts":{"value":"default"},"classifies":[{"id":"left_letter:a","pid":"left_letter","name":"a(660)"}]}
-        filters = (
-            [{"id": f"left_letter:{left_letter}", "pid": "left_letter", "name": "x(0)"}]
-            if left_letter
-            else []
-        )
+        filters = [
+            {"id": f"{pid}:{value}", "pid": pid, "name": f"{value}(0)"}
+            for pid, value in shard
+        ]
         d = {
             "page": page_no,
             "pageSize": page_size,
             "wfwfid": "2120",
             "sorts": {"value": "default"},
-            # "classifies": filters,
         }
+        if filters:
+            d["classifies"] = filters
         meta = kwargs.get("meta", {})
         meta["page_no"] = page_no
-        meta["left_letter"] = left_letter
+        meta["page_size"] = page_size
+        meta["shard"] = shard
         meta["search_id"] = search_id
         if priority := kwargs.get("priority"):
             meta["priority"] = priority
         kwargs["meta"] = meta
 
         return JsonRequest(
-            f"https://history.zjlib.cn/app/universal-search/search-list?wfwfid=2120&searchId={search_id}&params=",
+            f"{self.base_url}/app/universal-search/search-list?wfwfid=2120&searchId={search_id}&params=",
             data=d,
             cookies={"website_id": 73953},
             callback=self.parse_page,
+            errback=self.errback_page,
             **kwargs,
         )
 
 
+@functools.cache
+def var_pattern(*varnames):
+    names = "|".join(varnames)
+    return re.compile(rf"var\s+({names})\s*=\s*(.+?)\s*;?\s*$", flags=re.MULTILINE)
+
+
 def extract_var(varname, html):
-    m = re.search(rf"var\s+{varname}\s*=\s*(.+?)\s*;?\s*$", html, flags=re.MULTILINE)
-    return m.group(1)
+    m = var_pattern(varname).search(html)
+    return m.group(2)
+
+
+def extract_vars(html, *varnames):
+    """Extract several `var x = ...;` assignments in a single pass over the page"""
+    found = {}
+    for m in var_pattern(*varnames).finditer(html):
+        found.setdefault(m.group(1), m.group(2))
+        if len(found) == len(varnames):
+            break
+    # an assignment sharing its line with a preceding one is not seen by the single pass
+    return [found.get(varname) or extract_var(varname, html) for varname in varnames]
+
+
+def check_page(d, page_no, page_size):
+    """Return why a search-list response does not match the requested page, if it does not"""
+    if d.get("code") != 1:
+        return f"code={d.get('code')}"
+    d = d["data"]
+    if int(d["curPage"]) != page_no:
+        return f"curPage={d['curPage']}"
+    total_records = int(d["totalRecords"])
+    # the server silently clamps pageSize, which shows up as a mismatched totalPages
+    if int(d["totalPages"]) != -(-total_records // page_size):
+        return f"totalPages={d['totalPages']}, totalRecords={total_records}"
+    expected = max(min(page_size, total_records - (page_no - 1) * page_size), 0)
+    if len(d["results"]) != expected:
+        return f"results={len(d['results'])}, expected={expected}"
+    return None
+
+
+def format_shard(shard):
+    return ",".join(f"{pid}:{value}" for pid, value in shard) or "-"
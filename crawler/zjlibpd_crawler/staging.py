@@ -0,0 +1,88 @@
+import os
+import pickle
+import sqlite3
+import tempfile
+from pathlib import Path
+
+
+class StagingStore:
+    """Partial items staged between requests, by key
+
+    Requests only carry keys into this store instead of whole item dicts. The most recently
+    staged entries are kept in memory; older ones are spilled to an SQLite file. If a path
+    is given (e.g. in JOBDIR), everything is spilled there on close so that a resumed crawl
+    can pick the staged items up again; otherwise a temporary file is used and removed.
+    """
+
+    def __init__(self, path=None, max_in_memory=10000):
+        self.persistent = path is not None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix="zjlibpd-staging-", suffix=".sqlite")
+            os.close(fd)
+        self.path = Path(path)
+        self.max_in_memory = max_in_memory
+        self.memory = {}
+        self.db = sqlite3.connect(self.path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS staged (key TEXT PRIMARY KEY, value BLOB NOT NULL)"
+        )
+        self.spilled = self.db.execute("SELECT COUNT(*) FROM staged").fetchone()[0]
+
+    def put(self, key, value):
+        if key not in self.memory:
+            # drop a spilled copy which would be stale from now on
+            self._delete(key)
+        self.memory.pop(key, None)
+        self.memory[key] = value
+        while len(self.memory) > self.max_in_memory:
+            self._spill(next(iter(self.memory)))
+
+    def get(self, key, default=None):
+        if (value := self.memory.get(key, default)) is not default:
+            return value
+        if self.spilled and (
+            row := self.db.execute(
+                "SELECT value FROM staged WHERE key = ?", (key,)
+            ).fetchone()
+        ):
+            return pickle.loads(row[0])
+        return default
+
+    def pop(self, key, default=None):
+        if key in self.memory:
+            return self.memory.pop(key)
+        value = self.get(key, default)
+        self._delete(key)
+        return value
+
+    def keys(self):
+        keys = list(self.memory)
+        if self.spilled:
+            keys.extend(key for (key,) in self.db.execute("SELECT key FROM staged"))
+        return keys
+
+    def count(self):
+        return len(self.memory) + self.spilled
+
+    def close(self):
+        if self.persistent:
+            while self.memory:
+                self._spill(next(iter(self.memory)))
+            self.db.commit()
+            self.db.close()
+        else:
+            self.db.close()
+            self.path.unlink(missing_ok=True)
+
+    def _spill(self, key):
+        value = self.memory.pop(key)
+        self.db.execute(
+            "INSERT INTO staged (key, value) VALUES (?, ?)",
+            (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)),
+        )
+        self.spilled += 1
+
+    def _delete(self, key):
+        if self.spilled:
+            cur = self.db.execute("DELETE FROM staged WHERE key = ?", (key,))
+            self.spilled -= cur.rowcount
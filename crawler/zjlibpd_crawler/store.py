@@ -0,0 +1,121 @@
+"""Crawled items in an SQLite file, keyed by resource id
+
+Unlike the append-only items.json feed, re-crawled items replace the stored ones, so
+consumers can look items (or the sub resources of an item) up directly instead of loading
+and deduplicating the whole feed.
+
+Usage: python -m zjlibpd_crawler.store ITEMS_SQLITE [--parent ID | --merged | --id ID ...]
+streams the (selected) items to stdout as JSON lines, in the order they were first stored.
+"""
+
+import argparse
+import json
+import sqlite3
+import sys
+from pathlib import Path
+
+
+class ItemStore:
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS items (
+                id TEXT PRIMARY KEY,
+                parent TEXT,
+                merged INTEGER NOT NULL DEFAULT 0,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS items_parent ON items (parent);
+            CREATE INDEX IF NOT EXISTS items_merged ON items (merged);
+            """
+        )
+
+    def put(self, item):
+        # an update keeps the rowid, hence the position of the item in exports
+        self.db.execute(
+            """
+            INSERT INTO items (id, parent, merged, data) VALUES (?, ?, ?, ?)
+            ON CONFLICT (id) DO UPDATE
+            SET parent = excluded.parent, merged = excluded.merged, data = excluded.data
+            """,
+            (
+                item["id"],
+                item.get("__PARENT__"),
+                bool(item.get("__MERGED__")),
+                json.dumps(item, ensure_ascii=False),
+            ),
+        )
+
+    def get(self, id, default=None):
+        row = self.db.execute("SELECT data FROM items WHERE id = ?", (id,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def __contains__(self, id):
+        return (
+            self.db.execute("SELECT 1 FROM items WHERE id = ?", (id,)).fetchone()
+            is not None
+        )
+
+    def count(self):
+        return self.db.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+    def children(self, parent_id):
+        """Items crawled as sub resources of `parent_id`"""
+        return map(json.loads, self._rows("WHERE parent = ?", (parent_id,)))
+
+    def merged(self):
+        """Top-level items, i.e. those merged with their listing record"""
+        return map(json.loads, self._rows("WHERE merged = 1"))
+
+    def __iter__(self):
+        return map(json.loads, self._rows())
+
+    def export(self, f, rows=None):
+        """Write items (all of them by default) to `f` as JSON lines, without decoding them"""
+        for data in self._rows() if rows is None else rows:
+            f.write(data)
+            f.write("\n")
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def _rows(self, where="", params=()):
+        cur = self.db.execute(f"SELECT data FROM items {where} ORDER BY rowid", params)
+        return (data for (data,) in cur)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export items of an item store as JSON lines"
+    )
+    parser.add_argument("path")
+    selection = parser.add_mutually_exclusive_group()
+    selection.add_argument("--parent", help="only sub resources of this item")
+    selection.add_argument("--merged", action="store_true", help="only top-level items")
+    selection.add_argument("--id", action="append", help="only these items")
+    args = parser.parse_args()
+
+    store = ItemStore(args.path)
+    if args.parent:
+        rows = store._rows("WHERE parent = ?", (args.parent,))
+    elif args.merged:
+        rows = store._rows("WHERE merged = 1")
+    elif args.id:
+        rows = store._rows(f"WHERE id IN ({', '.join('?' * len(args.id))})", args.id)
+    else:
+        rows = None
+    store.export(sys.stdout, rows)
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 # source: https://github.com/Gowee/wzlibpd/blob/main/uploader/_gen.py
+import collections
 import json
 from pathlib import Path
 import logging
@@ -16,13 +17,80 @@ logging.basicConfig(level=LOGLEVEL)
 logger = logging.getLogger(__name__)
 
 
+ZHHANT_CACHE_SIZE = 1 << 20
+CacheInfo = collections.namedtuple(
+    "CacheInfo", ["hits", "misses", "maxsize", "currsize"]
+)
+
+
+class ZhhantCache:
+    """A bounded LRU cache of zh-Hant conversions, as field keys and many values repeat"""
+
+    def __init__(self, maxsize=ZHHANT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, text):
+        if (converted := self.cache.get(text)) is not None:
+            self.cache.move_to_end(text)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return converted
+
+    def put(self, text, converted):
+        self.cache[text] = converted
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.cache))
+
+
+zhhant_cache = ZhhantCache()
+
+
 def zhhant(text):
     if type(text) == str:
-        return zhconv.zhconv(text, "zh-Hant")
+        if (converted := zhhant_cache.get(text)) is None:
+            converted = zhconv.zhconv(text, "zh-Hant")
+            zhhant_cache.put(text, converted)
+        return converted
     else:
         return text
 
 
+def zhhant_many(texts):
+    """Convert a list of texts like zhhant, with all the uncached ones in a single call"""
+    converted = [
+        zhhant_cache.get(text) if type(text) == str else text for text in texts
+    ]
+    missing = list(
+        dict.fromkeys(
+            text
+            for text, result in zip(texts, converted)
+            if type(text) == str and result is None
+        )
+    )
+    if not missing:
+        return converted
+    results = None
+    if not any("\n" in text for text in missing):
+        # conversion never spans lines, so the texts are converted as lines of one text
+        results = zhconv.zhconv("\n".join(missing), "zh-Hant").split("\n")
+    if results is None or len(results) != len(missing):
+        results = [zhconv.zhconv(text, "zh-Hant") for text in missing]
+    results = dict(zip(missing, results))
+    for text, result in results.items():
+        zhhant_cache.put(text, result)
+    return [
+        results[text] if type(text) == str and result is None else result
+        for text, result in zip(texts, converted)
+    ]
+
+
 def construct_res_url(resid):
     return "{{ZJLib res link|%s}}" % resid
 
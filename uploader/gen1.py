@@ -1,251 +1,406 @@
 #!/usr/bin/env python3
 #
 from _gen import *
+import argparse
 import builtins
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, str(Path(__file__).parent / "../crawler"))
+from zjlibpd_crawler.jsonl import load
+from zjlibpd_crawler.merge import merge_resource
 
 DATA_PATH = Path(__file__).parent / "../crawler/items.json.all"
 
 
-def main():
-    mapping = {}
-    with open(DATA_PATH) as f:
-        for line in f:
-            line = json.loads(line)
-            mapping[line["id"]] = line
-
-    # redundant validation
-    subitems = set()
-    for _id, item in mapping.items():
-        for sub in item.get("sub_resources", []):
-            sub["__ATTRS__"] = {
-                zhhant(field["key"]): field.get("subs") or zhhant(field["value"])
-                for field in sub["fields"]
-            }
-            if sub["__ATTRS__"]["類型"] == "卷":
-                subitems.add(sub["id"])
-        item["__ATTRS__"] = {
-            zhhant(field["key"]): field.get("subs") or zhhant(field["value"])
-            for field in item["fields"]
-        }
-    tlitems = [id for id in mapping.keys() if id not in subitems]  # top-level items
-    # we rely on the insertion order guarantee of dict for stable ordering
-    for id in tlitems:
-        # tagged by our crawler
-        assert mapping[id].get("__PARENT__") is None, id
-        # commented out because we manually added several broken ones
-        # assert mapping[id].get('__MERGED__') is True
-    logger.info(f"Top-level items: {len(tlitems)}")
+class Items:
+    """Items of a JSON lines file by id, read from the file on demand
 
-    uploads = []
-    indices = [[]]
-    counts = [0]
-    built_categories = set()
+    An index of the offset of every id (the last line with it wins) is cached next to the
+    file, in FILE.idx, and rebuilt once the file's size or mtime changes. It also marks the
+    ids listed as volumes (卷) in the sub_resources of other items.
+    """
 
-    for id in tlitems:
-        item = mapping[id]
-        if len(indices[-1]) >= 2000:
-            indices.append([])
-            counts.append(0)
+    def __init__(self, path):
+        self.path = Path(path)
+        self.index_path = self.path.with_name(self.path.name + ".idx")
+        stat = self.path.stat()
+        self.version = f"{stat.st_size} {stat.st_mtime_ns}"
+        if not self._load_index():
+            logger.info(f"Indexing {self.path}")
+            self._build_index()
+            self._save_index()
+        self.file = open(self.path, "rb")
+
+    def ids(self):
+        return self.offsets.keys()
+
+    def get(self, id, default=None):
+        if (offset := self.offsets.get(id)) is None:
+            return default
+        self.file.seek(offset)
+        return annotate(json.loads(self.file.readline()))
+
+    def _load_index(self):
+        if not self.index_path.exists():
+            return False
+        with open(self.index_path) as f:
+            if f.readline().rstrip("\n") != self.version:
+                return False
+            self.offsets = {}
+            self.volumes = set()
+            for line in f:
+                id, offset, volume = line.rstrip("\n").split("\t")
+                self.offsets[id] = int(offset)
+                if volume == "1":
+                    self.volumes.add(id)
+        return True
+
+    def _build_index(self):
+        self.offsets = {}
+        volumes = set()
+        for offset, (id, vols) in load(self.path, with_offsets=True, transform=index_entry):
+            # we rely on the insertion order guarantee of dict for stable ordering
+            self.offsets[id] = offset
+            volumes.update(vols)
+        self.volumes = volumes & self.offsets.keys()
+
+    def _save_index(self):
+        tmp_path = self.index_path.with_name(self.index_path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            f.write(self.version + "\n")
+            for id, offset in self.offsets.items():
+                f.write(f"{id}\t{offset}\t{int(id in self.volumes)}\n")
+        os.replace(tmp_path, self.index_path)
+
+
+def index_entry(item):
+    """The id of an item and the ids of the volumes in its sub_resources"""
+    annotate(item)
+    volumes = [
+        sub["id"]
+        for sub in item.get("sub_resources", [])
+        if sub["__ATTRS__"]["類型"] == "卷"
+    ]
+    return item["id"], volumes
 
-        title = item["__ATTRS__"]["題名"]
-        sanitized_title = sanitize_title(title)
-        categories = set(categorize(sanitized_title))
-        unordered = False
 
-        if reader := item.get("__READER__"):
-            assert item.get("sub_resources") is None
+def annotate(item):
+    """Add the zh-Hant `__ATTRS__` of an item and of its sub resources"""
+    resources = [*item.get("sub_resources", []), item]
+    # keys and values of all fields, converted at once
+    converted = iter(
+        zhhant_many(
+            [
+                text
+                for resource in resources
+                for field in resource["fields"]
+                for text in (field["key"], field.get("value"))
+            ]
+        )
+    )
+    for resource in resources:
+        attrs = {}
+        for field in resource["fields"]:
+            key, value = next(converted), next(converted)
+            attrs[key] = field.get("subs") or value
+        resource["__ATTRS__"] = attrs
+    return item
+
+
+# the Items of DATA_PATH, opened by main() and, in worker processes, by init_worker()
+items = None
+# the file counter of books with several readers is the `i` left over from the loops of the
+# previous book, as in the original sequential loop; it is filled in by main()
+LEGACY_COUNTER = "\0i+1\0"
+
+
+def build_book(id):
+    """Generate the uploads of a top-level item
+
+    Returns the last value of its loop counter `i` (None if unset), and its title, its file
+    uploads, its lines in the index pages, the number of files listed there and its
+    categories, or None if it has nothing to upload.
+    """
+    item = items.get(id)
+    # tagged by our crawler
+    assert item.get("__PARENT__") is None, id
+    # commented out because we manually added several broken ones
+    # assert item.get('__MERGED__') is True
+
+    title = item["__ATTRS__"]["題名"]
+    sanitized_title = sanitize_title(title)
+    categories = set(categorize(sanitized_title))
+    unordered = False
+    uploads = []
+    index_lines = []
+    count = 0
+
+    if reader := item.get("__READER__"):
+        assert item.get("sub_resources") is None
+        if None in reader:
+            # some reader pages failed, and files are numbered by reader position
+            logger.warning(f"Incomplete readers for {item['id']}")
+            return None, None
+        vols = [
+            (
+                extract_blob_id(sub)
+                if isinstance(sub, dict)
+                else re.search(r"objectid=([\w-]+)($|&)", reader[0]).group(1),
+                sub,
+            )
+            for _ii, sub in enumerate(reader)
+        ]
+        if len(vols) == 1:
+            # (re.search(r"objectid=([\w-]+)($|&)", reader[0]).group(1)
+            vols = [(f"ZJLib-{item['id']} {sanitized_title}.pdf", vols[0])]
+        else:
             vols = [
                 (
-                    extract_blob_id(sub)
-                    if isinstance(sub, dict)
-                    else re.search(r"objectid=([\w-]+)($|&)", reader[0]).group(1),
-                    sub,
+                    f"ZJLib-{item['id']}-{LEGACY_COUNTER} {sanitized_title} 第{ii+1}冊.pdf",
+                    vol,
                 )
-                for _ii, sub in enumerate(reader)
+                for ii, vol in enumerate(vols)
             ]
-            if len(vols) == 1:
-                # (re.search(r"objectid=([\w-]+)($|&)", reader[0]).group(1)
-                vols = [(f"ZJLib-{item['id']} {sanitized_title}.pdf", vols[0])]
+    else:
+        subs = item.get("sub_resources")
+        if not subs:
+            logger.warning(f"No reader and sub_resources for {item['id']}")
+            return None, None
+        seen_blobs = set()
+        blobs = []
+        assert len(subs) > 0, item["id"]
+        # sometimes, the parent resource is included as a sub resource of itself
+        # so we filter them by type
+        for i, sub in enumerate(
+            filter(lambda sub: sub["__ATTRS__"]["類型"] == "卷", subs)
+        ):
+            sub = merge_resource(sub, items.get(sub["id"], {}))
+            if sub.get("__READER__") and sub["__READER__"][0] is not None:
+                assert len(sub["__READER__"]) == 1
+                blob_id = extract_blob_id(sub["__READER__"][0])
             else:
-                vols = [
-                    (f"ZJLib-{item['id']}-{i+1} {sanitized_title} 第{ii+1}冊.pdf", vol)
-                    for ii, vol in enumerate(vols)
-                ]
-        else:
-            subs = item.get("sub_resources")
-            if not subs:
-                logger.warning(f"No reader and sub_resources for {item['id']}")
-                continue
-            seen_blobs = set()
-            blobs = []
-            assert len(subs) > 0, item["id"]
-            # sometimes, the parent resource is included as a sub resource of itself
-            # so we filter them by type
-            for i, sub in enumerate(
-                filter(lambda sub: sub["__ATTRS__"]["類型"] == "卷", subs)
-            ):
-                sub = merge(
-                    sub, mapping.get(sub["id"], {}), strategy=Strategy.TYPESAFE_ADDITIVE
-                )
-                if sub.get("__READER__"):
-                    assert len(sub["__READER__"]) == 1
-                    blob_id = extract_blob_id(sub["__READER__"][0])
-                else:
-                    try:
-                        reader_field = next(
-                            field
-                            for field in sub["fields"]
-                            if field["key"] == "获取方式" or field["key"] == "阅读"
-                        )
-                    except StopIteration:
-                        logger.warning(f"No file for {item['id']}->{sub['id']}")
-                        continue
-                    if not (ors_url := reader_field.get("orsUrl")):
-                        assert len(reader_field["subs"]) == 1
-                        ors_url = reader_field["subs"][0]["orsUrl"]
-                    blob_id = re.search(r"fileId%3D([a-z0-9-]+)%", ors_url).group(1)
-                if not blobs or blob_id not in seen_blobs:
-                    blobs.append((blob_id, [sub]))
-                else:
-                    if blobs[-1][0] != blob_id:
-                        logger.warning(
-                            f"Volumes are unordered for {item['id']}->{blob_id}@{i} (seen {','.join(blob_id for blob_id, _ in blobs)})"
-                        )
-                        unordered = True
-                        # assert blobs[-1][0] == blob_id, f"{item['id']} {blob_id}"
-                    blobs[-1][1].append(sub)
-                seen_blobs.add(blob_id)
-
-            if not blobs:
-                logger.warning(
-                    f"No files for {item['id']} (subres={len(item['sub_resources'])})"
-                )
-                continue
-            assert blobs, item["id"]
-            if len(blobs) == 1:
-                filename = f"ZJLib-{item['id']} {sanitized_title}.pdf"
-                vols = [(filename, (blobs[0]))]
+                try:
+                    reader_field = next(
+                        field
+                        for field in sub["fields"]
+                        if field["key"] == "获取方式" or field["key"] == "阅读"
+                    )
+                except StopIteration:
+                    logger.warning(f"No file for {item['id']}->{sub['id']}")
+                    continue
+                if not (ors_url := reader_field.get("orsUrl")):
+                    assert len(reader_field["subs"]) == 1
+                    ors_url = reader_field["subs"][0]["orsUrl"]
+                blob_id = re.search(r"fileId%3D([a-z0-9-]+)%", ors_url).group(1)
+            if not blobs or blob_id not in seen_blobs:
+                blobs.append((blob_id, [sub]))
             else:
-                vols = []
-                for i, (blob_id, subs) in enumerate(blobs):
-                    filename = (
-                        f"ZJLib-{item['id']}-{i+1} {sanitized_title} 第{i+1}冊.pdf"
+                if blobs[-1][0] != blob_id:
+                    logger.warning(
+                        f"Volumes are unordered for {item['id']}->{blob_id}@{i} (seen {','.join(blob_id for blob_id, _ in blobs)})"
                     )
-                    vols.append((filename, (blob_id, subs)))
+                    unordered = True
+                    # assert blobs[-1][0] == blob_id, f"{item['id']} {blob_id}"
+                blobs[-1][1].append(sub)
+            seen_blobs.add(blob_id)
 
-        cats_list = "".join(f"[[:Category:{cat}|{cat}]]" for cat in categories)
-        if cats_list:
-            cats_list = " -> " + cats_list
-        if len(vols) == 1:
-            indices[-1].append(
-                f"* [[:File:{vols[0][0]}]]{construct_res_url(item['id'])}" + cats_list
+        if not blobs:
+            logger.warning(
+                f"No files for {item['id']} (subres={len(item['sub_resources'])})"
             )
-            counts[-1] += 1
+            return locals().get("i"), None
+        assert blobs, item["id"]
+        if len(blobs) == 1:
+            filename = f"ZJLib-{item['id']} {sanitized_title}.pdf"
+            vols = [(filename, (blobs[0]))]
         else:
-            indices[-1].append(f"* {title}{construct_res_url(item['id'])}" + cats_list)
-
-        prev_filename, prev_vol = None, None
-        for i in range(len(vols)):
-            filename, vol = vols[i]
-            assert (
-                l := len(filename.encode("utf-8"))
-            ) < 240, f"Filename too long: {item['id']} {filename} {l} > 240"
-            # if (l := len(filename.encode("utf-8"))) > 240:
-            #     logger.warning(f"Filename too long: {item['id']} {filename} {l} > 240")
-            if i + 1 < len(vols):
-                next_filename, next_vol = vols[i + 1]
-            fields = {"blobid": vol[0]}
-            ress = []
-            match vol:
-                case (blob_id, _url) if isinstance(_url, str):
-                    # url
-                    fields["resid"] = item["id"]
-                    fields["resname"] = item["__ATTRS__"]["題名"]
-                    ress.append((item["id"], item["__ATTRS__"]["題名"]))
-                    fields |= gen_attr_fields(item["__ATTRS__"], f"attr-")
-                    url = construct_pdf_url(blob_id)
-                case (blob_id, reader) if isinstance(reader, dict):
-                    # reader obj
-                    fields["resid"] = item["id"]
-                    fields["resname"] = item["__ATTRS__"]["題名"]
-                    ress.append((item["id"], item["__ATTRS__"]["題名"]))
-                    fields |= gen_attr_fields(item["__ATTRS__"], f"attr-")
-                    toc = gen_toc(vol[1])
-                    fields["toc"] = toc
-                    # blob_id = extract_blob_id(vol[1])
-                    url = construct_pdf_url(reader)
-                case (blob_id, subs) if isinstance(subs, list):
-                    # the blob file spans over multiple resources
-                    fields["nth"] = i + 1
-                    fields["total"] = len(vols)
-                    for ii, sub in enumerate(
-                        filter(lambda sub: sub["__ATTRS__"]["類型"] == "卷", subs)
-                    ):
-                        fields[f"resid{ii+1}"] = sub["id"]
-                        fields[f"resname{ii+1}"] = sub["__ATTRS__"]["題名"]
-                        ress.append((sub["id"], sub["__ATTRS__"]["題名"]))
-                        fields |= gen_attr_fields(sub["__ATTRS__"], f"attr{ii+1}-")
-                    fields["parentresid"] = item["id"]
-                    fields["parentresname"] = item["__ATTRS__"]["題名"]
-                    fields |= {
-                        f"parentattr-{k}": v for k, v in item["__ATTRS__"].items()
-                    }
-                    reader = None
-                    url = construct_pdf_url(blob_id)
-                    for sub in subs:
-                        # some reader pages are broken (java NULL POINTER), we try to find a valid one
-                        if reader := sub.get("__READER__"):
-                            assert len(reader) == 1
-                            fields["toc"] = gen_toc(reader[0])
-                            url = construct_pdf_url(reader[0])
-                            break
-                    # if len(subs) == 1:
-                    #     attr_fields |= attr_fields
-                case _:
-                    raise NotImplementedError
-            fields["searchid"] = 24016
-            fields_wikitext = "\n".join(
-                [f"  |{k}={'' if v is None else v}" for k, v in fields.items()]
-            )
-            booknav_wikitext = ""
-            if len(vols) > 1:
-                indices[-1].append(
-                    f"** [[:File:{filename}]]："
-                    + "；".join(
-                        f"{name}" for id, name in ress
-                    )  # {construct_res_url(id)}
+            vols = []
+            for i, (blob_id, subs) in enumerate(blobs):
+                filename = (
+                    f"ZJLib-{item['id']}-{i+1} {sanitized_title} 第{i+1}冊.pdf"
                 )
-                counts[-1] += 1
-                # fmt: off
-                booknav_wikitext = f"{{{{ZJLibBookNaviBar|prev={prev_filename or ""}|next={next_filename or ""}|parentresid={item['id']}|nth={i+1}|total={len(vols)}}}}}\n"
-            wikitext = f"""=={{{{int:filedesc}}}}==
+                vols.append((filename, (blob_id, subs)))
+
+    cats_list = "".join(f"[[:Category:{cat}|{cat}]]" for cat in categories)
+    if cats_list:
+        cats_list = " -> " + cats_list
+    if len(vols) == 1:
+        index_lines.append(
+            f"* [[:File:{vols[0][0]}]]{construct_res_url(item['id'])}" + cats_list
+        )
+        count += 1
+    else:
+        index_lines.append(f"* {title}{construct_res_url(item['id'])}" + cats_list)
+
+    prev_filename, prev_vol = None, None
+    for i in range(len(vols)):
+        filename, vol = vols[i]
+        assert (
+            l := len(filename.encode("utf-8"))
+        ) < 240, f"Filename too long: {item['id']} {filename} {l} > 240"
+        # if (l := len(filename.encode("utf-8"))) > 240:
+        #     logger.warning(f"Filename too long: {item['id']} {filename} {l} > 240")
+        if i + 1 < len(vols):
+            next_filename, next_vol = vols[i + 1]
+        fields = {"blobid": vol[0]}
+        ress = []
+        match vol:
+            case (blob_id, _url) if isinstance(_url, str):
+                # url
+                fields["resid"] = item["id"]
+                fields["resname"] = item["__ATTRS__"]["題名"]
+                ress.append((item["id"], item["__ATTRS__"]["題名"]))
+                fields |= gen_attr_fields(item["__ATTRS__"], f"attr-")
+                url = construct_pdf_url(blob_id)
+            case (blob_id, reader) if isinstance(reader, dict):
+                # reader obj
+                fields["resid"] = item["id"]
+                fields["resname"] = item["__ATTRS__"]["題名"]
+                ress.append((item["id"], item["__ATTRS__"]["題名"]))
+                fields |= gen_attr_fields(item["__ATTRS__"], f"attr-")
+                toc = gen_toc(vol[1])
+                fields["toc"] = toc
+                # blob_id = extract_blob_id(vol[1])
+                url = construct_pdf_url(reader)
+            case (blob_id, subs) if isinstance(subs, list):
+                # the blob file spans over multiple resources
+                fields["nth"] = i + 1
+                fields["total"] = len(vols)
+                for ii, sub in enumerate(
+                    filter(lambda sub: sub["__ATTRS__"]["類型"] == "卷", subs)
+                ):
+                    fields[f"resid{ii+1}"] = sub["id"]
+                    fields[f"resname{ii+1}"] = sub["__ATTRS__"]["題名"]
+                    ress.append((sub["id"], sub["__ATTRS__"]["題名"]))
+                    fields |= gen_attr_fields(sub["__ATTRS__"], f"attr{ii+1}-")
+                fields["parentresid"] = item["id"]
+                fields["parentresname"] = item["__ATTRS__"]["題名"]
+                fields |= {
+                    f"parentattr-{k}": v for k, v in item["__ATTRS__"].items()
+                }
+                reader = None
+                url = construct_pdf_url(blob_id)
+                for sub in subs:
+                    # some reader pages are broken (java NULL POINTER), we try to find a valid one
+                    if (reader := sub.get("__READER__")) and reader[0] is not None:
+                        assert len(reader) == 1
+                        fields["toc"] = gen_toc(reader[0])
+                        url = construct_pdf_url(reader[0])
+                        break
+                # if len(subs) == 1:
+                #     attr_fields |= attr_fields
+            case _:
+                raise NotImplementedError
+        fields["searchid"] = 24016
+        fields_wikitext = "\n".join(
+            [f"  |{k}={'' if v is None else v}" for k, v in fields.items()]
+        )
+        booknav_wikitext = ""
+        if len(vols) > 1:
+            index_lines.append(
+                f"** [[:File:{filename}]]："
+                + "；".join(
+                    f"{name}" for id, name in ress
+                )  # {construct_res_url(id)}
+            )
+            count += 1
+            # fmt: off
+            booknav_wikitext = f"{{{{ZJLibBookNaviBar|prev={prev_filename or ""}|next={next_filename or ""}|parentresid={item['id']}|nth={i+1}|total={len(vols)}}}}}\n"
+        wikitext = f"""=={{{{int:filedesc}}}}==
 {booknav_wikitext}\
 {{{{Book in the Zhejiang Library
 {fields_wikitext}
 }}}}
 
 """ + "".join(
-                f"[[Category:{cat}]]\n" for cat in categories
-            )
+            f"[[Category:{cat}]]\n" for cat in categories
+        )
 
-            resids_tag = item["id"]
-            if len(ress) > 1:
-                resids_tag += "->" + ",".join(id for id, name in ress)
-            cats_tag = ""
-            if categories:
-                cats_tag = "; " + ", ".join(
-                    f"[[:c:Category:{cat}|{cat}]]" for cat in categories
-                )
-            uploads.append(
-                (
-                    "File:" + filename,
-                    wikitext,
-                    f"{title} (batch task; zjlib:{resids_tag}; blob:{blob_id}; {i+1}/{len(vols)} of {item['__ATTRS__']['題名']}{cats_tag})",
-                    url,
-                )
+        resids_tag = item["id"]
+        if len(ress) > 1:
+            resids_tag += "->" + ",".join(id for id, name in ress)
+        cats_tag = ""
+        if categories:
+            cats_tag = "; " + ", ".join(
+                f"[[:c:Category:{cat}|{cat}]]" for cat in categories
             )
+        uploads.append(
+            (
+                "File:" + filename,
+                wikitext,
+                f"{title} (batch task; zjlib:{resids_tag}; blob:{blob_id}; {i+1}/{len(vols)} of {item['__ATTRS__']['題名']}{cats_tag})",
+                url,
+            )
+        )
+
+        prev_filename, prev_vol = filename, vol
+    return i, (title, uploads, index_lines, count, list(categories))
+
+
+def fill_legacy_counter(value, i):
+    if isinstance(value, str):
+        return value.replace(LEGACY_COUNTER, str(i + 1))
+    if isinstance(value, (list, tuple)):
+        return type(value)(fill_legacy_counter(v, i) for v in value)
+    return value
+
+
+def init_worker():
+    global items
+    # each worker reads the data file through its own handle
+    items = Items(DATA_PATH)
 
-            prev_filename, prev_vol = filename, vol
+
+def build_book_with_cache_info(id):
+    """build_book, also returning the pid of the process and the state of its zhhant cache"""
+    return *build_book(id), os.getpid(), zhhant_cache.cache_info()
+
+
+def main():
+    global items
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-j", "--jobs", type=int, help="processes generating wikitext (default: all cores)"
+    )
+    args = parser.parse_args()
+    jobs = args.jobs or os.cpu_count() or 1
+
+    items = Items(DATA_PATH)
+    tlitems = [id for id in items.ids() if id not in items.volumes]  # top-level items
+    logger.info(f"Top-level items: {len(tlitems)}")
+
+    uploads = []
+    indices = [[]]
+    counts = [0]
+    built_categories = set()
+
+    if jobs == 1:
+        results = map(build_book_with_cache_info, tlitems)
+    else:
+        executor = ProcessPoolExecutor(jobs, initializer=init_worker)
+        results = executor.map(build_book_with_cache_info, tlitems, chunksize=16)
+
+    legacy_i = None
+    # the latest zhhant cache info of each process, as they have caches of their own
+    cache_infos = {}
+    # merged in order, so that the output does not depend on the number of workers
+    for id, (last_i, result, pid, cache_info) in zip(tlitems, results):
+        cache_infos[pid] = cache_info
+        if len(indices[-1]) >= 2000:
+            indices.append([])
+            counts.append(0)
+        if result is not None and any(LEGACY_COUNTER in u[0] for u in result[1]):
+            assert legacy_i is not None, f"No file counter for {id}"
+            result = fill_legacy_counter(result, legacy_i)
+        if last_i is not None:
+            legacy_i = last_i
+        if result is None:
+            continue
+        title, book_uploads, index_lines, count, categories = result
+        uploads.extend(book_uploads)
+        indices[-1].extend(index_lines)
+        counts[-1] += count
         for cat in categories:
             if cat in built_categories:
                 continue
@@ -255,11 +410,14 @@ def main():
                 (
                     "Category:" + cat,
                     category_wikitext,
-                    f"{title} -> {cat} (batch task; zjlib:{item['id']})",
+                    f"{title} -> {cat} (batch task; zjlib:{id})",
                     None,
                 )
             )
 
+    if jobs > 1:
+        executor.shutdown()
+
     for index in indices:
         index.append("")
         index.append("[[Category:Book in the Zhejiang Library]]")
@@ -299,6 +457,10 @@ def main():
             f.write(f'"\tCount: {counts[-1]}\t')
 
     logger.info(f"Written {uploads_file_path}, {indices_file_path}")
+    cache_infos[os.getpid()] = zhhant_cache.cache_info()
+    logger.info(
+        f"zhhant cache of {len(cache_infos)} processes: {CacheInfo(*map(sum, zip(*cache_infos.values())))}"
+    )
 
 
 if __name__ == "__main__":